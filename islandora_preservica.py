@@ -1,17 +1,20 @@
+import io
 import os
+import errno
 import os.path
+import stat
 import shutil
-import pathlib
+import posixpath
 import re
+import sys
+import time
+import threading
+import itertools
+import zlib
+import struct
 import hashlib
 import xml.etree.ElementTree as ET
 from datetime import datetime
-from bdbag import bdbag_api
-from bagit import BagValidationError
-from bdbag.bdbagit import BaggingInterruptedError
-from pyrsistent import thaw
-from zipfile import ZipFile
-from openpyxl import Workbook
 from os.path import basename
 
 #------------------------------------------------------------------------------------------------------------------------------------------------------
@@ -28,17 +31,855 @@ proj_path = 'M:/IDT/DAM/*PROJECT FOLDER*'
 #Linux Project Path
 #proj_path = '/home/jdewees/department/IDT/DAM/*PROJECT FOLDER*'
 proj_log_file = os.path.join(proj_path, 'project_log.txt')
+#when True, create_pax() writes the PAX zip archives itself instead of through ZipFile, calculating their SHA-1 as they are written so pax_metadata()
+#does not read each archive back (see create_pax() for the cost)
+pax_hash_while_writing = False
+#size of the buffers used for CRC-32 and checksum calculation on large files
+pax_chunk_size = 8 * 1024 * 1024
+#number of threads used to send batched mkdir/rename/move operations to the (network) drive at once
+metadata_workers = 16
+#when True, MODS.xml and DC.xml are parsed with lxml if it is installed (see read_xml_fields())
+xml_use_lxml = True
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# STORAGE BACKENDS
+# Every function goes through the module-level "storage" object for listing, stat, mkdir, move, remove and opening files
+# LocalStorage is used by default, assign storage = MemoryStorage() to run the stages against an in-memory filesystem for testing or profiling
+# NOTE the bdbag functions (extract_bag, validate_bag, revert_bag) read and write the local disk directly, so the bag stages need LocalStorage
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+
+#the methods shared by both storage backends, built on listdir() and stat()
+class Storage:
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def isdir(self, path):
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except FileNotFoundError:
+            return False
+
+    #(st_dev, st_ino) of a file, the same for every hard link to it, or None if the backend has no inode numbers
+    def file_id(self, path):
+        st = self.stat(path)
+        if not st.st_ino:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    #yields every file and directory below "path", each directory before its contents (like pathlib.Path.rglob('*'), in sorted order)
+    def walk(self, path):
+        for name in sorted(self.listdir(path)):
+            path_entry = os.path.join(path, name)
+            yield path_entry
+            if self.isdir(path_entry):
+                yield from self.walk(path_entry)
+
+    #moves into "dst" if it is an existing directory, the same as shutil.move
+    def move_target(self, src, dst):
+        if self.isdir(dst):
+            return os.path.join(dst, basename(src.rstrip('/\\')))
+        return dst
+
+#local disk backend
+#listdir() uses os.scandir, and keeps the DirEntry objects it returns so that the stat(), isdir() and exists() calls that usually follow a listing
+#are answered from them (DirEntry only stats the file the first time stat() is called, and on Windows not even then) instead of another round-trip
+#to the (network) drive, each listing replaces the cached entries of that directory, and cached entries are dropped when the path is changed or
+#after "stat_cache_ttl" seconds
+class LocalStorage(Storage):
+
+    def __init__(self, stat_cache_ttl = 5):
+        self.stat_cache_ttl = stat_cache_ttl
+        #directory -> (time listed, name -> DirEntry)
+        self.listings = dict()
+        self.cache_lock = threading.Lock()
+
+    def listdir(self, path):
+        with os.scandir(path) as entries:
+            listing = dict((entry.name, entry) for entry in entries)
+        with self.cache_lock:
+            self.listings[os.path.normpath(path)] = (time.monotonic(), listing)
+        return list(listing)
+
+    #the DirEntry for "path" from a recent listing of its directory, or None
+    def cached_entry(self, path):
+        key = os.path.normpath(path)
+        with self.cache_lock:
+            cached = self.listings.get(os.path.dirname(key) or '.')
+            if cached is None or time.monotonic() - cached[0] >= self.stat_cache_ttl:
+                return None
+            return cached[1].get(os.path.basename(key))
+
+    def stat(self, path):
+        entry = self.cached_entry(path)
+        if entry is not None:
+            return entry.stat()
+        return os.stat(path)
+
+    def isdir(self, path):
+        entry = self.cached_entry(path)
+        if entry is not None:
+            try:
+                return entry.is_dir()
+            except OSError:
+                return False
+        return os.path.isdir(path)
+
+    def exists(self, path):
+        if self.cached_entry(path) is not None:
+            return True
+        return os.path.exists(path)
+
+    #always a fresh stat, as the stat results of listed entries have no inode numbers on Windows
+    def file_id(self, path):
+        st = os.stat(path)
+        if not st.st_ino:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    #drops the cached entries for "path" and everything below it
+    def forget(self, *paths):
+        with self.cache_lock:
+            for path in paths:
+                key = os.path.normpath(path)
+                prefix = key + os.sep
+                cached = self.listings.get(os.path.dirname(key) or '.')
+                if cached is not None:
+                    cached[1].pop(os.path.basename(key), None)
+                for directory in [d for d in self.listings if d == key or d.startswith(prefix)]:
+                    del self.listings[directory]
+
+    def open(self, path, mode = 'r', buffering = -1):
+        if 'r' not in mode or '+' in mode:
+            self.forget(path)
+        return open(path, mode, buffering = buffering)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+        self.forget(path)
+
+    def makedirs(self, path, exist_ok = False):
+        os.makedirs(path, exist_ok = exist_ok)
+        self.forget(path)
+
+    def rename(self, src, dst):
+        os.rename(src, dst)
+        self.forget(src, dst)
+
+    def replace(self, src, dst):
+        os.replace(src, dst)
+        self.forget(src, dst)
+
+    def move(self, src, dst):
+        dst = self.move_target(src, dst)
+        shutil.move(src, dst)
+        self.forget(src, dst)
+
+    def remove(self, path):
+        os.remove(path)
+        self.forget(path)
+
+    def rmtree(self, path):
+        shutil.rmtree(path)
+        self.forget(path)
+
+    #replaces "dst" with a hard link to "src", linking beside it first so "dst" is never missing
+    def link(self, src, dst):
+        path_link = dst + '.link'
+        os.link(src, path_link)
+        os.replace(path_link, dst)
+        self.forget(dst, path_link)
+
+#a file opened on MemoryStorage, written back to the store when it is closed
+class MemoryFile(io.BytesIO):
+
+    def __init__(self, store, path, data, writable):
+        io.BytesIO.__init__(self, data)
+        self.store = store
+        self.path = path
+        self.name = path
+        self.writable_file = writable
+
+    def close(self):
+        if not self.closed and self.writable_file:
+            self.store.commit(self.path, self.getvalue())
+        io.BytesIO.close(self)
+
+#in-memory backend for tests and for profiling the CPU cost of each stage apart from the disk
+#paths are normalised to forward slashes, so the os.path.join paths built by the stages work unchanged on Windows and Linux
+#"children" indexes the names in each directory (in the order they were added), so listing, renaming and removing only touch the entries involved
+#each file written gets a new inode number, which link() shares with the new path the same as a hard link on disk
+class MemoryStorage(Storage):
+
+    def __init__(self):
+        #path -> (data, modification time, inode number)
+        self.files = dict()
+        self.inodes = itertools.count(1)
+        self.dirs = dict()
+        self.children = dict()
+        self.lock = threading.RLock()
+
+    def key(self, path):
+        return os.path.normpath(path).replace('\\', '/')
+
+    #the root, and the top of a relative path, always exist
+    def has_dir(self, key):
+        return key in ('', '.', '/') or key in self.dirs
+
+    def parent(self, key):
+        return posixpath.dirname(key)
+
+    def add_entry(self, key):
+        self.children.setdefault(self.parent(key), dict())[posixpath.basename(key)] = None
+
+    def drop_entry(self, key):
+        self.children.get(self.parent(key), dict()).pop(posixpath.basename(key), None)
+
+    #"key" and every key below it, parents before their contents
+    def subtree(self, key):
+        keys = [key]
+        for sub_key in keys:
+            keys.extend(posixpath.join(sub_key, name) for name in self.children.get(sub_key, ()))
+        return keys
+
+    #copies a directory tree from the local disk into the store under "path"
+    def load_tree(self, local_path, path):
+        self.makedirs(path, exist_ok = True)
+        for name in os.listdir(local_path):
+            local_entry = os.path.join(local_path, name)
+            if os.path.isdir(local_entry):
+                self.load_tree(local_entry, os.path.join(path, name))
+            else:
+                local_hand = open(local_entry, 'rb')
+                self.commit(self.key(os.path.join(path, name)), local_hand.read())
+                local_hand.close()
+
+    def commit(self, key, data):
+        with self.lock:
+            if not self.has_dir(self.parent(key)):
+                raise FileNotFoundError(key)
+            self.files[key] = (bytes(data), time.time(), next(self.inodes))
+            self.add_entry(key)
+
+    def listdir(self, path):
+        key = self.key(path)
+        with self.lock:
+            if not self.has_dir(key):
+                raise FileNotFoundError(path) if key not in self.files else NotADirectoryError(path)
+            return list(self.children.get(key, ()))
+
+    def stat(self, path):
+        key = self.key(path)
+        with self.lock:
+            if key in self.dirs:
+                return os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 1, 0, 0, 0, self.dirs[key], self.dirs[key], self.dirs[key]))
+            if key in self.files:
+                data, mtime, ino = self.files[key]
+                return os.stat_result((stat.S_IFREG | 0o644, ino, 0, 1, 0, 0, len(data), mtime, mtime, mtime))
+        raise FileNotFoundError(path)
+
+    def open(self, path, mode = 'r', buffering = -1):
+        key = self.key(path)
+        with self.lock:
+            if key in self.dirs:
+                raise IsADirectoryError(path)
+            if not self.has_dir(self.parent(key)):
+                raise FileNotFoundError(path)
+            exists = key in self.files
+            if 'x' in mode and exists:
+                raise FileExistsError(path)
+            if 'r' in mode and not exists:
+                raise FileNotFoundError(path)
+            if 'w' in mode or 'x' in mode or not exists:
+                data = b''
+                self.files[key] = (data, time.time(), next(self.inodes))
+                self.add_entry(key)
+            else:
+                data = self.files[key][0]
+        memory_file = MemoryFile(self, key, data, 'r' not in mode or '+' in mode)
+        if 'a' in mode:
+            memory_file.seek(0, io.SEEK_END)
+        if 'b' in mode:
+            return memory_file
+        return io.TextIOWrapper(memory_file, encoding = 'utf-8', write_through = True)
+
+    def mkdir(self, path):
+        key = self.key(path)
+        with self.lock:
+            if key in self.dirs or key in self.files:
+                raise FileExistsError(path)
+            if not self.has_dir(self.parent(key)):
+                raise FileNotFoundError(path)
+            self.dirs[key] = time.time()
+            self.add_entry(key)
+
+    def makedirs(self, path, exist_ok = False):
+        key = self.key(path)
+        with self.lock:
+            if self.has_dir(key):
+                if not exist_ok:
+                    raise FileExistsError(path)
+                return
+            if not self.has_dir(self.parent(key)):
+                self.makedirs(self.parent(key), exist_ok = True)
+            self.dirs[key] = time.time()
+            self.add_entry(key)
+
+    def rename(self, src, dst):
+        src_key = self.key(src)
+        dst_key = self.key(dst)
+        with self.lock:
+            if src_key not in self.files and src_key not in self.dirs:
+                raise FileNotFoundError(src)
+            if not self.has_dir(self.parent(dst_key)):
+                raise FileNotFoundError(dst)
+            if dst_key in self.dirs or (dst_key in self.files and src_key in self.dirs):
+                raise FileExistsError(dst)
+            #the same as the OS, a directory cannot be moved inside itself
+            if dst_key.startswith(src_key + '/'):
+                raise OSError(errno.EINVAL, 'cannot move a directory into itself', src)
+            for key in self.subtree(src_key):
+                new_key = dst_key + key[len(src_key):]
+                for table in (self.files, self.dirs, self.children):
+                    if key in table:
+                        table[new_key] = table.pop(key)
+            self.drop_entry(src_key)
+            self.add_entry(dst_key)
+
+    def replace(self, src, dst):
+        self.rename(src, dst)
+
+    def move(self, src, dst):
+        self.rename(src, self.move_target(src, dst))
+
+    def remove(self, path):
+        key = self.key(path)
+        with self.lock:
+            if key in self.dirs:
+                raise IsADirectoryError(path)
+            if key not in self.files:
+                raise FileNotFoundError(path)
+            del self.files[key]
+            self.drop_entry(key)
+
+    #files are immutable bytes in the store, so both paths simply share the same data
+    def link(self, src, dst):
+        src_key = self.key(src)
+        dst_key = self.key(dst)
+        with self.lock:
+            if src_key not in self.files:
+                raise FileNotFoundError(src)
+            if not self.has_dir(self.parent(dst_key)):
+                raise FileNotFoundError(dst)
+            self.files[dst_key] = self.files[src_key]
+            self.add_entry(dst_key)
+
+    def rmtree(self, path):
+        key = self.key(path)
+        with self.lock:
+            if key not in self.dirs:
+                raise FileNotFoundError(path)
+            for sub_key in self.subtree(key):
+                for table in (self.files, self.dirs, self.children):
+                    table.pop(sub_key, None)
+            self.drop_entry(key)
+
+storage = LocalStorage()
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# I/O SCHEDULER FOR SHARED STORAGE
+# enable_io_limits() wraps "storage" so that every listing, stat, mkdir, move, remove, read and write made by the stages is limited to a number of MB/s and
+# operations/s, which keeps the impact on the shared drive predictable while other people are using it
+# Metadata operations and small reads/writes have their own lane and are always served before bulk data, so they are not stuck behind multi-GB reads
+# NOTE bdbag works on the local disk directly, validate_bag() charges the size of each bag to the scheduler before bdbag reads it, but extract_bags() and
+# the revert_bag() in process_bags() are not limited
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+
+#a token bucket refilled at "rate" tokens per second, holding at most one second's worth
+class TokenBucket:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    #seconds until "amount" tokens can be taken
+    def wait_time(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(amount, self.rate)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+#limits I/O to "mb_per_sec" megabytes and "ops_per_sec" operations per second (None for no limit), serving the metadata lane before the bulk lane
+#keeps running totals for each lane and prints them every "report_interval" seconds if it is set
+class IOScheduler:
+
+    lanes = ('metadata', 'bulk')
+
+    def __init__(self, mb_per_sec = None, ops_per_sec = None, report_interval = None, small_io_size = 64 * 1024):
+        self.byte_bucket = TokenBucket(mb_per_sec * 1024 * 1024) if mb_per_sec else None
+        self.op_bucket = TokenBucket(ops_per_sec) if ops_per_sec else None
+        self.small_io_size = small_io_size
+        self.condition = threading.Condition()
+        self.waiting = dict((lane, 0) for lane in self.lanes)
+        self.totals = dict((lane, {'ops': 0, 'bytes': 0, 'wait': 0.0}) for lane in self.lanes)
+        self.started = time.monotonic()
+        self.reporter_stop = threading.Event()
+        if report_interval:
+            reporter = threading.Thread(target = self.report_every, args = (report_interval,), daemon = True)
+            reporter.start()
+
+    #the lane for an operation moving "nbytes" bytes
+    def lane_for(self, nbytes):
+        return 'metadata' if nbytes <= self.small_io_size else 'bulk'
+
+    #blocks until one operation moving "nbytes" bytes is allowed in "lane"
+    #the bytes are taken in slices no larger than the byte bucket, so a large read never leaves the bucket in debt for the metadata lane to wait out,
+    #and the metadata lane can go between the slices
+    def acquire(self, lane, nbytes = 0):
+        with self.condition:
+            self.waiting[lane] += 1
+            start = time.monotonic()
+            ops = 1
+            remaining = nbytes
+            while True:
+                slice_bytes = remaining if self.byte_bucket is None else min(remaining, self.byte_bucket.rate)
+                if lane == 'bulk' and self.waiting['metadata'] > 0:
+                    wait = 0.05
+                else:
+                    wait = 0
+                    if self.op_bucket is not None and ops > 0:
+                        wait = max(wait, self.op_bucket.wait_time(ops))
+                    if self.byte_bucket is not None and slice_bytes > 0:
+                        wait = max(wait, self.byte_bucket.wait_time(slice_bytes))
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                if self.op_bucket is not None:
+                    self.op_bucket.take(ops)
+                if self.byte_bucket is not None:
+                    self.byte_bucket.take(slice_bytes)
+                ops = 0
+                remaining -= slice_bytes
+                if remaining <= 0:
+                    break
+            self.waiting[lane] -= 1
+            totals = self.totals[lane]
+            totals['ops'] += 1
+            totals['bytes'] += nbytes
+            totals['wait'] += time.monotonic() - start
+            self.condition.notify_all()
+
+    #returns a copy of the running totals, with the average MB/s and ops/s since the scheduler started
+    def stats(self):
+        with self.condition:
+            elapsed = max(time.monotonic() - self.started, 0.001)
+            stats = dict()
+            for lane in self.lanes:
+                totals = dict(self.totals[lane])
+                totals['mb_per_sec'] = totals['bytes'] / elapsed / (1024 * 1024)
+                totals['ops_per_sec'] = totals['ops'] / elapsed
+                totals['queued'] = self.waiting[lane]
+                stats[lane] = totals
+            return stats
+
+    def report(self):
+        stats = self.stats()
+        print('I/O | ' + ' | '.join('{}: {} ops {:.1f} ops/s {:.1f} MB/s {:.1f}s waiting {} queued'.format(lane, s['ops'], s['ops_per_sec'], s['mb_per_sec'], s['wait'], s['queued']) for lane, s in stats.items()))
+
+    def report_every(self, report_interval):
+        while not self.reporter_stop.wait(report_interval):
+            self.report()
+
+    def close(self):
+        self.reporter_stop.set()
+
+#a file opened on ThrottledStorage, writes are charged to the scheduler before they are passed on and reads as soon as they return
+#the file descriptor is deliberately not exposed, so the PAX writer reads through a buffer that can be metered instead of a memory map
+class ThrottledFile:
+
+    def __init__(self, file_hand, scheduler):
+        self.file_hand = file_hand
+        self.scheduler = scheduler
+
+    def charge(self, nbytes):
+        self.scheduler.acquire(self.scheduler.lane_for(nbytes), nbytes)
+
+    def read(self, size = -1):
+        data = self.file_hand.read(size)
+        self.charge(len(data))
+        return data
+
+    def readinto(self, buffer):
+        read = self.file_hand.readinto(buffer)
+        self.charge(read or 0)
+        return read
+
+    def readline(self, size = -1):
+        line = self.file_hand.readline(size)
+        self.charge(len(line))
+        return line
+
+    def readlines(self):
+        lines = self.file_hand.readlines()
+        self.charge(sum(len(line) for line in lines))
+        return lines
+
+    def write(self, data):
+        self.charge(len(data))
+        return self.file_hand.write(data)
+
+    def fileno(self):
+        raise io.UnsupportedOperation('fileno')
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.file_hand, name)
+
+#wraps another storage backend, passing each operation through the scheduler first
+class ThrottledStorage(Storage):
+
+    def __init__(self, backend, scheduler):
+        self.backend = backend
+        self.scheduler = scheduler
+
+    def listdir(self, path):
+        self.scheduler.acquire('metadata')
+        return self.backend.listdir(path)
+
+    def stat(self, path):
+        self.scheduler.acquire('metadata')
+        return self.backend.stat(path)
+
+    def open(self, path, mode = 'r', buffering = -1):
+        self.scheduler.acquire('metadata')
+        return ThrottledFile(self.backend.open(path, mode, buffering), self.scheduler)
+
+    def mkdir(self, path):
+        self.scheduler.acquire('metadata')
+        self.backend.mkdir(path)
+
+    def makedirs(self, path, exist_ok = False):
+        self.scheduler.acquire('metadata')
+        self.backend.makedirs(path, exist_ok = exist_ok)
+
+    def rename(self, src, dst):
+        self.scheduler.acquire('metadata')
+        self.backend.rename(src, dst)
+
+    def replace(self, src, dst):
+        self.scheduler.acquire('metadata')
+        self.backend.replace(src, dst)
+
+    def move(self, src, dst):
+        self.scheduler.acquire('metadata')
+        self.backend.move(src, dst)
+
+    def remove(self, path):
+        self.scheduler.acquire('metadata')
+        self.backend.remove(path)
+
+    def rmtree(self, path):
+        self.scheduler.acquire('metadata')
+        self.backend.rmtree(path)
+
+    def link(self, src, dst):
+        self.scheduler.acquire('metadata')
+        self.backend.link(src, dst)
+
+    def file_id(self, path):
+        self.scheduler.acquire('metadata')
+        return self.backend.file_id(path)
+
+#this function limits all further I/O made through "storage" and returns the scheduler, so its stats() and report() can be checked
+#e.g. enable_io_limits(mb_per_sec = 40, ops_per_sec = 200, report_interval = 60) before running validate_bags() or create_pax() during working hours
+def enable_io_limits(mb_per_sec = None, ops_per_sec = None, report_interval = None):
+    global storage
+    scheduler = IOScheduler(mb_per_sec, ops_per_sec, report_interval)
+    storage = ThrottledStorage(storage, scheduler)
+    print('Limited I/O to {} MB/s and {} operations/s'.format(mb_per_sec or 'unlimited', ops_per_sec or 'unlimited'))
+    return scheduler
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# BATCHED FILESYSTEM OPERATIONS
+# Over SMB each mkdir/rename/move is a network round-trip, so stages that make thousands of them queue them in a MetadataBatch and run them on a thread pool
+# An operation waits for every earlier operation in the batch on the same path, a parent of it, or anything inside it (so a parent mkdir finishes before
+# the move into it, and the files in a folder are written before the folder is renamed), everything else runs concurrently
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+
+class MetadataBatch:
+
+    def __init__(self):
+        self.ops = []
+        #path -> indexes of the operations on exactly that path
+        self.exact = dict()
+        #path -> indexes of the operations on that path or anything below it
+        self.subtree = dict()
+        self.errors = []
+        self.errors_lock = threading.Lock()
+
+    def mkdir(self, path, message = None):
+        self.add(message, 'mkdir', (path,), [path])
+
+    def move(self, src, dst, message = None):
+        self.add(message, 'move', (src, dst), [src, dst])
+
+    def rename(self, src, dst, message = None):
+        self.add(message, 'rename', (src, dst), [src, dst])
+
+    def remove(self, path, message = None):
+        self.add(message, 'remove', (path,), [path])
+
+    #queues any function as an operation on "paths"
+    def call(self, function, args, paths, message = None):
+        self.add(message, function, args, paths)
+
+    def add(self, message, function, args, paths):
+        index = len(self.ops)
+        deps = set()
+        for path in paths:
+            path = os.path.normpath(path)
+            deps.update(self.subtree.get(path, []))
+            for ancestor in path_ancestors(path):
+                deps.update(self.exact.get(ancestor, []))
+        for path in paths:
+            path = os.path.normpath(path)
+            self.exact.setdefault(path, []).append(index)
+            self.subtree.setdefault(path, []).append(index)
+            for ancestor in path_ancestors(path):
+                self.subtree.setdefault(ancestor, []).append(index)
+        self.ops.append((message, function, args, sorted(deps)))
+
+    #runs the queued operations on "workers" threads and returns a list of (operation, error) for every operation that failed,
+    #including operations skipped because an operation they depend on failed
+    #ThreadPoolExecutor starts operations in the order they were queued and dependencies are always queued first, so waiting on them cannot deadlock the pool
+    def run(self, workers = None, raise_errors = False):
+        import concurrent.futures
+        futures = []
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers or metadata_workers)
+        try:
+            for message, function, args, deps in self.ops:
+                futures.append(pool.submit(self.run_op, message, function, args, [futures[dep] for dep in deps]))
+        finally:
+            pool.shutdown(wait = True)
+        if raise_errors and self.errors:
+            raise self.errors[0][1]
+        return self.errors
+
+    def run_op(self, message, function, args, dep_futures):
+        description = message or '{} {}'.format(function if isinstance(function, str) else function.__name__, ' -> '.join(str(arg) for arg in args))
+        for dep_future in dep_futures:
+            if not dep_future.result():
+                self.record_error(description, RuntimeError('skipped because an operation it depends on failed'))
+                return False
+        try:
+            if isinstance(function, str):
+                getattr(storage, function)(*args)
+            else:
+                function(*args)
+        except Exception as err:
+            self.record_error(description, err)
+            return False
+        #one write per line, so lines from different threads are not interleaved
+        if message:
+            print(message + '\n', end = '')
+        return True
+
+    def record_error(self, description, err):
+        with self.errors_lock:
+            self.errors.append((description, err))
+        print('ERROR: {} | {}\n'.format(description, err), end = '')
+
+#returns every parent directory of "path", nearest first
+def path_ancestors(path):
+    ancestors = []
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        ancestors.append(parent)
+        path = parent
+        parent = os.path.dirname(path)
+    return ancestors
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# STREAMING METADATA EXTRACTION
+# The stages only need a few fields from MODS.xml and DC.xml (the first mods:identifier, dc:title and the dc:identifier list), so read_xml_fields() streams
+# the record with iterparse, clears every element once it has been looked at and stops reading as soon as the fields it was asked for are found
+# lxml is used when it is installed (and xml_use_lxml is True), otherwise xml.etree
+# Every parse is timed and added to "xml_stats", run under tracemalloc (python -X tracemalloc) to also record the peak memory of each parse
+# NOTE tracemalloc only sees memory allocated by Python, so it does not include the memory used inside lxml
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+
+mods_identifier = '{http://www.loc.gov/mods/v3}identifier'
+dc_title = '{http://purl.org/dc/elements/1.1/}title'
+dc_identifier = '{http://purl.org/dc/elements/1.1/}identifier'
+
+#keeps a row per record parsed with its time, bytes read and (under tracemalloc) peak memory, running totals, and the record with the highest of each
+#write_csv() writes the rows out, so individual large MODS records can be spotted
+#tracemalloc's peak covers the whole process, so peak memory is only recorded for parses that did not overlap another parse (the watch_bags() and
+#distributed_worker() threads parse records at the same time), and even then it includes anything other threads allocated during the parse
+class XMLStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.started = 0
+        self.records = 0
+        #(path, seconds, bytes read, peak memory or None) for every record, in the order they finished
+        self.rows = []
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.slowest = (0.0, None)
+        self.largest = (0, None)
+        self.peak_memory = (0, None)
+
+    #called when a parse starts, returns a token for finish() and whether the parse is the only one running
+    def start(self):
+        with self.lock:
+            self.active += 1
+            self.started += 1
+            return self.started, self.active == 1
+
+    #called when a parse ends, returns True if no other parse ran at any point during it
+    def finish(self, token, alone):
+        with self.lock:
+            self.active -= 1
+            return alone and self.started == token
+
+    def add(self, path, seconds, bytes_read, peak_memory = None):
+        with self.lock:
+            self.records += 1
+            self.rows.append((path, seconds, bytes_read, peak_memory))
+            self.seconds += seconds
+            self.bytes_read += bytes_read
+            self.slowest = max(self.slowest, (seconds, path), key = lambda record: record[0])
+            self.largest = max(self.largest, (bytes_read, path), key = lambda record: record[0])
+            if peak_memory is not None:
+                self.peak_memory = max(self.peak_memory, (peak_memory, path), key = lambda record: record[0])
+
+    def report(self):
+        with self.lock:
+            if self.records == 0:
+                print('XML | no records parsed')
+                return
+            print('XML | {} records | {:.3f}s total | {:.2f}ms average | {:.1f} MB read'.format(self.records, self.seconds, self.seconds / self.records * 1000, self.bytes_read / (1024 * 1024)))
+            print('XML | slowest: {:.2f}ms {}'.format(self.slowest[0] * 1000, self.slowest[1]))
+            print('XML | most read: {} bytes {}'.format(self.largest[0], self.largest[1]))
+            if self.peak_memory[1] is not None:
+                print('XML | peak memory (parses that ran alone): {} bytes {}'.format(self.peak_memory[0], self.peak_memory[1]))
+
+    #writes a CSV with a row per record parsed, the peak memory is left empty for parses that overlapped another parse or ran without tracemalloc
+    def write_csv(self, path_csv):
+        import csv
+        csv_hand = storage.open(path_csv, 'w')
+        writer = csv.writer(csv_hand, lineterminator = '\n')
+        writer.writerow(['path', 'seconds', 'bytes_read', 'peak_memory'])
+        with self.lock:
+            for path, seconds, bytes_read, peak_memory in self.rows:
+                writer.writerow([path, '{:.6f}'.format(seconds), bytes_read, '' if peak_memory is None else peak_memory])
+        csv_hand.close()
+        print('XML | wrote {} records to {}'.format(len(self.rows), path_csv))
+
+xml_stats = XMLStats()
+
+#returns the iterparse function to use, importing lxml the first time it is needed
+xml_iterparse = None
+def get_iterparse():
+    global xml_iterparse
+    if xml_iterparse is None:
+        xml_iterparse = ET.iterparse
+        if xml_use_lxml:
+            try:
+                from lxml import etree
+                xml_iterparse = etree.iterparse
+            except ImportError:
+                pass
+    return xml_iterparse
+
+#this function returns a dict of the text of the elements in "first" and "every" that are direct children of the root of the XML file at "path",
+#the same elements tree.find() and tree.findall() return: the first match for each tag in "first" (None if there is none) and a list of every match for each
+#tag in "every", the file is only read until every tag in "first" has been found unless "every" is given
+def read_xml_fields(path, first = (), every = ()):
+    fields = dict((tag, None) for tag in first)
+    fields.update((tag, []) for tag in every)
+    missing = set(first)
+    iterparse = get_iterparse()
+    token, alone = xml_stats.start()
+    import tracemalloc
+    tracing = alone and tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        memory_start = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    xml_hand = None
+    try:
+        xml_hand = storage.open(path, 'rb')
+        depth = 0
+        root = None
+        for event, elem in iterparse(xml_hand, events = ('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            #elements inside the root's children are never needed, only the text of the child itself
+            if depth > 1:
+                elem.clear()
+                continue
+            if depth == 0:
+                break
+            if elem.tag in missing:
+                fields[elem.tag] = elem.text
+                missing.discard(elem.tag)
+            elif elem.tag in fields and elem.tag not in first:
+                fields[elem.tag].append(elem.text)
+            #the root's children are dropped once they have been looked at, so only the element being parsed is held in memory
+            root.clear()
+            if not missing and not every:
+                break
+        bytes_read = xml_hand.tell()
+    finally:
+        if xml_hand is not None:
+            xml_hand.close()
+        alone = xml_stats.finish(token, alone)
+    peak_memory = tracemalloc.get_traced_memory()[1] - memory_start if tracing and alone else None
+    xml_stats.add(path, time.perf_counter() - start, bytes_read, peak_memory)
+    return fields
 
 #this function takes the folder containing all the preservation masters and renames to be the "container" folder which will ultimately be used for OPEX incremental ingest
 #also creates a "project_log.txt" file to store variables so that an ingest project can be worked on over multiple sessions
 def create_container():
     print('----CREATING CONTAINER----')
-    project_log_hand = open(proj_log_file, 'a')
+    project_log_hand = storage.open(proj_log_file, 'a')
     now = datetime.now()
     date_time = now.strftime('%Y-%m-%d_%H-%M-%S')
     project_log_hand.write(date_time + '\n')
     container = 'container_' + date_time
-    os.rename(os.path.join(proj_path, orig_dir), os.path.join(proj_path, container))
+    storage.rename(os.path.join(proj_path, orig_dir), os.path.join(proj_path, container))
     project_log_hand.write(container + '\n')
     print('Container directory: {}'.format(container))
     project_log_hand.close()
@@ -47,7 +888,7 @@ def create_container():
 #particular resource
 def folder_ds_files():
     print('----CREATING FOLDER STRUCTURE FOR PRESERVATION MASTERS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
@@ -55,111 +896,137 @@ def folder_ds_files():
     file_count = 0
     folder_name = ''
     path_container = os.path.join(proj_path, container)
-    for file in os.listdir(path = path_container):
+    for file in storage.listdir(path_container):
         file_root = file.split('-')[0]
         path_containerfile = os.path.join(proj_path, container, file)
         if  file_root == folder_name:
             path_foldername = os.path.join(proj_path, container, folder_name)
             path_foldernamefile = os.path.join(proj_path, container, folder_name, file)
-            shutil.move(path_containerfile, path_foldernamefile)
+            storage.move(path_containerfile, path_foldernamefile)
             file_count += 1
         else:
             folder_name = file_root
             path_foldername = os.path.join(proj_path, container, folder_name)
             path_foldernamefile = os.path.join(proj_path, container, folder_name, file)
-            os.mkdir(path_foldername)
+            storage.mkdir(path_foldername)
             folder_count += 1
-            shutil.move(path_containerfile, path_foldernamefile)
+            storage.move(path_containerfile, path_foldernamefile)
             file_count += 1
-    for folder in os.listdir(path = path_container):
+    for folder in storage.listdir(path_container):
         path_folder = os.path.join(proj_path, container, folder)
         if folder.startswith('bags_'):
             continue
         else:
-            num_files = len(os.listdir(path_folder))
+            num_files = len(storage.listdir(path_folder))
             if num_files > 99:
                 folder_name = os.path.join(proj_path, container, folder + "-001-" + str(num_files))
-                os.rename(path_folder, folder_name)
+                storage.rename(path_folder, folder_name)
             elif num_files > 9:
                 folder_name = os.path.join(proj_path, container, folder + "-001-0" + str(num_files))
-                os.rename(path_folder, folder_name)
+                storage.rename(path_folder, folder_name)
             else:
                 folder_name = os.path.join(proj_path, container, folder + "-001-00" + str(num_files))
-                os.rename(path_folder, folder_name)
+                storage.rename(path_folder, folder_name)
             print('{} created'.format(folder_name))
     print('Created and renamed {} subdirectories and moved {} files into them'.format(folder_count, file_count))
 
 #this function creates a subdir in "container" to hold all the bags exported from Islandora, and manipulate them separate from the preservation masters
 def create_bags_dir():
     print('----CREATING BAGS SUBDIRECTORY----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     date_time = vars[0].strip()
     container = vars[1].strip()
     bags_dir = 'bags_' + date_time
-    os.mkdir(os.path.join(proj_path, container, bags_dir))
+    storage.mkdir(os.path.join(proj_path, container, bags_dir))
     project_log_hand.close()
-    project_log_hand = open(proj_log_file, 'a')
+    project_log_hand = storage.open(proj_log_file, 'a')
     project_log_hand.write(bags_dir + '\n')
     print('Created bags directory: {}'.format(bags_dir))
     project_log_hand.close()
 
 #this function extracts the zipped bags into unzipped bags, and then deletes the zipped bags
 def extract_bags():
+    from bdbag import bdbag_api
     print('----EXTRACTING BAGS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     container = vars[1].strip()
     bags_dir = vars[2].strip()
     num_bags = 0
     path_bagsdir = os.path.join(proj_path, container, bags_dir)
-    for file in os.listdir(path = path_bagsdir):
+    for file in storage.listdir(path_bagsdir):
         path_bagsdirfile = os.path.join(proj_path, container, bags_dir, file)
         bdbag_api.extract_bag(path_bagsdirfile, output_path = path_bagsdir, temp=False)
         print('extracting bag: {}'.format(file))
         num_bags += 1
-    for bag in os.listdir(path = path_bagsdir):
+    for bag in storage.listdir(path_bagsdir):
         path_bagsdirbag = os.path.join(proj_path, container, bags_dir, bag)
         if bag.endswith('.zip'):
             print('removing zipped bag: {}'.format(bag))
-            os.remove(path_bagsdirbag)
+            storage.remove(path_bagsdirbag)
     print('Extracted {} bags'.format(str(num_bags)))
     project_log_hand.close()
 
 #this function validates the bags to ensure the checksums don't indicate any corruption of files and checks for any other types of erros
 #also logs the errors to a "validation_error_log.txt" for a record of problems which is also used in a later function
+#returns False if any bag is invalid
 def validate_bags():
     print('----VALIDATING BAGS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     bags_dir = vars[2].strip()
-    error_log_handle = open(os.path.join(proj_path, 'validation_error_log.txt'), 'a')
+    error_log_handle = storage.open(os.path.join(proj_path, 'validation_error_log.txt'), 'a')
     num_bags = 0
+    num_invalid = 0
     path_bagsdir = os.path.join(proj_path, container, bags_dir)
-    for directory in os.listdir(path = path_bagsdir):
+    for directory in storage.listdir(path_bagsdir):
         path_directory = os.path.join(proj_path, container, bags_dir, directory)
         print('attempting to validate bag: {}'.format(directory))
         num_bags += 1
-        try:
-            bdbag_api.validate_bag(path_directory, fast = False)
-        except BagValidationError:
-            error_log_handle.write('Bag Validation Error | Directory: ' + directory + '\n')
-        except BaggingInterruptedError:
-            error_log_handle.write('Bagging Interruped Error | Directory: ' + directory + '\n')
-        except RuntimeError:
-            error_log_handle.write('Runtime Error | Directory: ' + directory + '\n')
-    print('Validated {} bags'.format(str(num_bags)))
+        if not validate_bag(path_directory, error_log_handle):
+            num_invalid += 1
+    print('Validated {} bags | {} invalid'.format(str(num_bags), str(num_invalid)))
     error_log_handle.close()
+    return num_invalid == 0
+
+#validates a single unzipped bag, writing any error to the open validation error log
+#returns True if the bag is valid
+def validate_bag(path_directory, error_log_handle):
+    from bdbag import bdbag_api
+    from bagit import BagValidationError
+    from bdbag.bdbagit import BaggingInterruptedError
+    directory = basename(path_directory)
+    try:
+        if isinstance(storage, ThrottledStorage):
+            #bdbag reads the bag straight from the disk, so with I/O limits on the size of the bag is charged to the scheduler before it is read
+            bag_bytes = 0
+            for path in storage.walk(path_directory):
+                st = storage.stat(path)
+                if stat.S_ISREG(st.st_mode):
+                    bag_bytes += st.st_size
+            storage.scheduler.acquire('bulk', bag_bytes)
+        bdbag_api.validate_bag(path_directory, fast = False)
+    except BagValidationError:
+        error_log_handle.write('Bag Validation Error | Directory: ' + directory + '\n')
+    except BaggingInterruptedError:
+        error_log_handle.write('Bagging Interruped Error | Directory: ' + directory + '\n')
+    except RuntimeError:
+        error_log_handle.write('Runtime Error | Directory: ' + directory + '\n')
+    else:
+        return True
+    return False
 
 #this function creates an Excel spreadsheet that attemtps to match preservation assets and access assets up to each other
 #will likely uncover preservation assets with no access corrolaries and vice versa which will require manual rectification
 def create_id_ss():
+    from openpyxl import Workbook
     print('----CREATING ASSET CROSSWALK SPREADSHEET----')
     wb = Workbook()
     ws = wb.active
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     container = vars[1].strip()
     bags_dir = vars[2].strip()
@@ -170,16 +1037,15 @@ def create_id_ss():
     pres_file_list = []
     path_container = os.path.join(proj_path, container)
     path_bagsdir = os.path.join(proj_path, container, bags_dir)
-    for folder in os.listdir(path = path_container):
+    for folder in storage.listdir(path_container):
         if folder.startswith('bags_'):
             continue
         else:
             pres_file_list.append(folder)
     bag_dict = dict()
-    for bag in os.listdir(path =  path_bagsdir):
+    for bag in storage.listdir(path_bagsdir):
         path_bagmd = os.path.join(proj_path, container, bags_dir, bag, 'MODS.xml')
-        tree = ET.parse(path_bagmd)
-        identifier = tree.find('{http://www.loc.gov/mods/v3}identifier').text
+        identifier = read_xml_fields(path_bagmd, first = [mods_identifier])[mods_identifier]
         bag_dict[identifier] = bag
     for item in pres_file_list:
         if item in bag_dict.keys():
@@ -189,126 +1055,263 @@ def create_id_ss():
     for item in bag_dict.keys():
         if item not in pres_file_list:
             ws.append(['', item, bag_dict[item]])
-    wb.save('pres_acc_bag_ids_suppl.xlsx')
+    xlsx_hand = storage.open('pres_acc_bag_ids_suppl.xlsx', 'wb')
+    wb.save(xlsx_hand)
+    xlsx_hand.close()
     print('Created pres_acc_bag_ids.xlsx')
 
+#this function finds files with identical content anywhere in "container" (preservation masters and the access copies in the bags) before they are packaged
+#candidates are narrowed down by size first, then by a hash of their first and last "partial_size" bytes, and only then by a full SHA-1, both hashes on "workers" threads
+#hashes are kept in "dedupe_index.json" in the project folder and reused on later runs for files whose size and modification time have not changed
+#the duplicate groups are written to "duplicates_report.json", and with "link" every copy after the first is replaced by a hard link to it
+#files of the same size that are already hard links to each other (the same storage.file_id(), for example from an earlier run with "link") are counted as
+#a single copy under the first of their paths, and are re-linked together if that copy is replaced
+def find_duplicates(min_size = 1024 * 1024, partial_size = 64 * 1024, workers = 4, link = False):
+    import concurrent.futures
+    import json
+    print('----FINDING DUPLICATE FILES----')
+    project_log_hand = storage.open(proj_log_file, 'r')
+    vars = project_log_hand.readlines()
+    project_log_hand.close()
+    container = vars[1].strip()
+    path_container = os.path.join(proj_path, container)
+    path_index = os.path.join(proj_path, 'dedupe_index.json')
+    index = dict()
+    if storage.exists(path_index):
+        index_hand = storage.open(path_index, 'r')
+        index = json.load(index_hand)
+        index_hand.close()
+    size_dict = dict()
+    file_count = 0
+    for path in storage.walk(path_container):
+        if path.endswith('.pax.zip'):
+            continue
+        st = storage.stat(path)
+        if stat.S_ISDIR(st.st_mode) or st.st_size < min_size:
+            continue
+        file_count += 1
+        rel_path = os.path.relpath(path, path_container).replace(os.sep, '/')
+        entry = index.get(rel_path)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            entry = {'size': st.st_size, 'mtime': st.st_mtime, 'partial': None, 'sha1': None}
+            index[rel_path] = entry
+        size_dict.setdefault(st.st_size, []).append(rel_path)
+    #first path of each file -> the other paths hard linked to it
+    hard_links = dict()
+    candidates = []
+    for paths in size_dict.values():
+        if len(paths) < 2:
+            continue
+        first_paths = dict()
+        for rel_path in paths:
+            file_id = storage.file_id(os.path.join(path_container, rel_path))
+            first_path = first_paths.setdefault(file_id, rel_path) if file_id is not None else rel_path
+            if first_path == rel_path:
+                candidates.append(rel_path)
+            else:
+                hard_links.setdefault(first_path, []).append(rel_path)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+    try:
+        to_hash = [rel_path for rel_path in candidates if index[rel_path]['partial'] is None]
+        for rel_path, partial in zip(to_hash, pool.map(lambda rel_path: partial_hash(os.path.join(path_container, rel_path), partial_size), to_hash)):
+            index[rel_path]['partial'] = partial
+        partial_dict = dict()
+        for rel_path in candidates:
+            partial_dict.setdefault((index[rel_path]['size'], index[rel_path]['partial']), []).append(rel_path)
+        candidates = [rel_path for paths in partial_dict.values() if len(paths) > 1 for rel_path in paths]
+        to_hash = [rel_path for rel_path in candidates if index[rel_path]['sha1'] is None]
+        for rel_path, sha1_checksum in zip(to_hash, pool.map(lambda rel_path: sha1_file(os.path.join(path_container, rel_path)), to_hash)):
+            index[rel_path]['sha1'] = sha1_checksum
+    finally:
+        pool.shutdown(wait = True)
+    sha1_dict = dict()
+    for rel_path in candidates:
+        sha1_dict.setdefault(index[rel_path]['sha1'], []).append(rel_path)
+    groups = [{'sha1': sha1_checksum, 'size': index[paths[0]]['size'], 'paths': sorted(paths)} for sha1_checksum, paths in sorted(sha1_dict.items()) if len(paths) > 1]
+    #entries for files that no longer exist are dropped from the index
+    found = set(rel_path for paths in size_dict.values() for rel_path in paths)
+    index = dict((rel_path, entry) for rel_path, entry in index.items() if rel_path in found)
+    index_hand = storage.open(path_index, 'w')
+    json.dump(index, index_hand)
+    index_hand.close()
+    wasted = sum(group['size'] * (len(group['paths']) - 1) for group in groups)
+    report_hand = storage.open(os.path.join(proj_path, 'duplicates_report.json'), 'w')
+    json.dump({'container': container, 'checked': file_count, 'duplicate_bytes': wasted, 'groups': groups}, report_hand, indent = 1)
+    report_hand.close()
+    for group in groups:
+        print('duplicate content ({} bytes): {}'.format(group['size'], ' | '.join(group['paths'])))
+    if link:
+        batch = MetadataBatch()
+        link_count = 0
+        for group in groups:
+            for copy_path in group['paths'][1:]:
+                for rel_path in [copy_path] + hard_links.get(copy_path, []):
+                    batch.call(storage.link, (os.path.join(path_container, group['paths'][0]), os.path.join(path_container, rel_path)), [os.path.join(path_container, rel_path)], 'linked {} to {}'.format(rel_path, group['paths'][0]))
+                    link_count += 1
+        errors = batch.run()
+        print('Replaced {} duplicate files with hard links'.format(link_count - len(errors)))
+    print('Checked {} files | Found {} groups of duplicates | {} duplicate bytes'.format(file_count, len(groups), wasted))
+    return groups
+
+#hash of the size and the first and last "partial_size" bytes of a file, a cheap first check before hashing the whole file
+def partial_hash(path, partial_size):
+    partial = hashlib.sha1()
+    file_hand = storage.open(path, 'rb')
+    try:
+        size = storage.stat(path).st_size
+        partial.update(str(size).encode('ascii'))
+        partial.update(file_hand.read(partial_size))
+        if size > partial_size:
+            file_hand.seek(max(partial_size, size - partial_size))
+            partial.update(file_hand.read(partial_size))
+    finally:
+        file_hand.close()
+    return partial.hexdigest()
+
 #this function begins the process of creating the PAX structure necessary for ingest
 #"Representation_Preservation" folder is created, and each image is given a separate subdir inside of it
 def representation_preservation():
     print('----CREATING REPRESENTATION_PRESERVATION FOLDERS AND MOVING ASSETS INTO THEM----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     folder_count = 0
     file_count = 0
     path_container = os.path.join(proj_path, container)
-    rep_pres = 'Representation_Preservation'
-    for directory in os.listdir(path = path_container):
+    batch = MetadataBatch()
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
         if directory.startswith('bags_'):
             continue
-        path = os.path.join(proj_path, container, directory, rep_pres)
-        os.mkdir(path)
+        file_count += representation_preservation_asset(path_directory, batch)
         folder_count += 1
-        for file in os.listdir(path = path_directory):
-            path_directoryfile = os.path.join(proj_path, container, directory, file)
-            if file == rep_pres:
-                continue
-            else:
-                file_name = file.split('.')[0]
-                os.mkdir(os.path.join(path, file_name))
-                print('created directory: {}'.format(path + '/' + file_name))
-                shutil.move(path_directoryfile, os.path.join(path, file_name, file))
-                print('moved file: {}'.format(path + '/' + file_name + '/' + file))
-            file_count += 1
-    print('Created {} Representation_Preservation directories | Moved {} files into created directories'.format(folder_count, file_count))
+    errors = batch.run()
+    print('Created {} Representation_Preservation directories | Moved {} files into created directories | {} errors'.format(folder_count, file_count, len(errors)))
+    return not errors
+
+#creates the "Representation_Preservation" folder for a single asset directory and moves each preservation file into its own subdir
+#the operations are added to "batch" if one is given, otherwise they are run straight away
+#returns the number of files moved
+def representation_preservation_asset(path_directory, batch = None):
+    rep_pres = 'Representation_Preservation'
+    file_count = 0
+    path = os.path.join(path_directory, rep_pres)
+    asset_batch = batch or MetadataBatch()
+    files = [file for file in storage.listdir(path_directory) if file != rep_pres]
+    #folders created by an earlier run that was interrupted are reused, and only the files still in the asset directory are moved
+    existing = set()
+    if storage.isdir(path):
+        existing = set(storage.listdir(path))
+    else:
+        asset_batch.mkdir(path)
+    for file in files:
+        path_directoryfile = os.path.join(path_directory, file)
+        file_name = file.split('.')[0]
+        if file_name not in existing:
+            asset_batch.mkdir(os.path.join(path, file_name), 'created directory: {}'.format(path + '/' + file_name))
+            existing.add(file_name)
+        asset_batch.move(path_directoryfile, os.path.join(path, file_name, file), 'moved file: {}'.format(path + '/' + file_name + '/' + file))
+        file_count += 1
+    if batch is None:
+        asset_batch.run(raise_errors = True)
+    return file_count
 
 #this function processes the access assets and metadata contained within the Islandora bags and reverts the bag into a simple directory without the bag manifests
 #the function renames the access asset by checking the MODS record and pulling the title field
 #this function removes many unnecessary files provided by Islandora during bag export, ultimately leaving the access asset and any metadata files
 def process_bags():
     print('----PROCESSING BAGS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     bags_dir = vars[2].strip()
     num_bags = 0
-    error_log_handle = open(os.path.join(proj_path, 'validation_error_log.txt'), 'r')
+    error_log_handle = storage.open(os.path.join(proj_path, 'validation_error_log.txt'), 'r')
     error_log = error_log_handle.read()
     error_log_handle.close()
     error_log_str = ''
     for line in error_log:
         error_log_str = error_log_str + line
     path_bagsdir = os.path.join(proj_path, container, bags_dir)
-    for directory in os.listdir(path = path_bagsdir):
+    for directory in storage.listdir(path_bagsdir):
         path_bagsdirdirectory = os.path.join(proj_path, container, bags_dir, directory)
         #skips any directories that raised errors during validation
         if error_log_str.find(directory) != -1 :
             continue
         else:
             print('attempting to revert bag: {}'.format(directory))
-            obj_file_name = ''
-            extension = ''
-            #converts the bags back into normal directories, removing bagit and manifest files
-            bdbag_api.revert_bag(path_bagsdirdirectory)
-            #removes unnecessary files generated by Islandora
-            unnecessary_files = ['foo.xml', 'foxml.xml', 'JP2.jp2', 'JPG.jpg', 'POLICY.xml', 'PREVIEW.jpg', 'RELS-EXT.rdf', 'RELS-INT.rdf', 'TN.jpg', 'HOCR.html', 'OCR.txt', 'MP4.mp4', 'PROXY_MP3.mp3', 'TIFF.tif']
-            for file in os.listdir(path = path_bagsdirdirectory):
-                if file in unnecessary_files:
-                    os.remove(os.path.join(proj_path, container, bags_dir, directory, file))
-                if re.search('^OBJ', file):
-                    obj_file_name = file
-                    extension = obj_file_name.split('.')[1].strip()
-                elif re.search('^PDF', file):
-                    obj_file_name = file
-                    extension = obj_file_name.split('.')[1].strip()
-            path_objfilename = os.path.join(proj_path, container, bags_dir, directory, obj_file_name)
-            #use xml.etree to identify filename from MODS.xml
-            tree = ET.parse(os.path.join(path_bagsdirdirectory, 'MODS.xml'))
-            identifier = tree.find('{http://www.loc.gov/mods/v3}identifier').text
-            #rename the OBJ file to original filename pulled from MODS.xml
-            os.rename(path_objfilename, os.path.join(path_bagsdirdirectory, identifier + '.' + extension))
+            process_bag(path_bagsdirdirectory)
         num_bags += 1
     print('Processed {} bags'.format(str(num_bags)))
 
+#reverts a single bag, removes the unnecessary Islandora files and renames the OBJ (or PDF) file to the MODS identifier
+#returns the MODS identifier
+def process_bag(path_bagsdirdirectory):
+    from bdbag import bdbag_api
+    obj_file_name = ''
+    extension = ''
+    #converts the bags back into normal directories, removing bagit and manifest files
+    #a bag already reverted by an earlier run that was interrupted is left as it is
+    if storage.exists(os.path.join(path_bagsdirdirectory, 'bagit.txt')):
+        bdbag_api.revert_bag(path_bagsdirdirectory)
+    #removes unnecessary files generated by Islandora
+    unnecessary_files = ['foo.xml', 'foxml.xml', 'JP2.jp2', 'JPG.jpg', 'POLICY.xml', 'PREVIEW.jpg', 'RELS-EXT.rdf', 'RELS-INT.rdf', 'TN.jpg', 'HOCR.html', 'OCR.txt', 'MP4.mp4', 'PROXY_MP3.mp3', 'TIFF.tif']
+    for file in storage.listdir(path_bagsdirdirectory):
+        if file in unnecessary_files:
+            storage.remove(os.path.join(path_bagsdirdirectory, file))
+        if re.search('^OBJ', file):
+            obj_file_name = file
+            extension = obj_file_name.split('.')[1].strip()
+        elif re.search('^PDF', file):
+            obj_file_name = file
+            extension = obj_file_name.split('.')[1].strip()
+    path_objfilename = os.path.join(path_bagsdirdirectory, obj_file_name)
+    #identify filename from MODS.xml
+    identifier = read_xml_fields(os.path.join(path_bagsdirdirectory, 'MODS.xml'), first = [mods_identifier])[mods_identifier]
+    #rename the OBJ file to original filename pulled from MODS.xml, unless an earlier run already has
+    if obj_file_name:
+        storage.rename(path_objfilename, os.path.join(path_bagsdirdirectory, identifier + '.' + extension))
+    return identifier
+
 #this function continues to create the PAX structure by creating a "Representation_Access" folder and creating individual subdirs for all access assets in it
 def representation_access():
     print('----CREATING REPRESENTATION_ACCESS FOLDERS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     folder_count = 0
     rep_acc = 'Representation_Access'
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    batch = MetadataBatch()
+    for directory in storage.listdir(path_container):
         path_diracc = os.path.join(proj_path, container, directory, rep_acc)
         if directory.startswith('bags_'):
             print('bags_ folder found - skipped')
         else:
-            os.mkdir(path_diracc)
-            print('created {}'.format(path_diracc))
+            batch.mkdir(path_diracc, 'created {}'.format(path_diracc))
         folder_count += 1
-    print('Created {} Representation_Access directories'.format(folder_count))
+    errors = batch.run()
+    print('Created {} Representation_Access directories | {} errors'.format(folder_count - len(errors), len(errors)))
+    return not errors
 
 #this function creates an "access_ids.txt" file to store an identifier pulled from the MODS record as well as the path to the access assets in "bags_dir"
 #this will then allow the access assets to be merged into the "container" folder in their "Representation_Access" subdirectories
 def access_id_path():
     print('----CREATING LOG OF IDENTIFIERS AND FILE PATHS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     bags_dir = vars[2].strip()
-    access_id_hand = open(os.path.join(proj_path, 'access_ids.txt'), 'a')
+    access_id_hand = storage.open(os.path.join(proj_path, 'access_ids.txt'), 'a')
     access_count = 0
     path_bagsdir = os.path.join(proj_path, container, bags_dir)
-    for directory in os.listdir(path = path_bagsdir):
+    for directory in storage.listdir(path_bagsdir):
         path_bagsdirdirectory = os.path.join(proj_path, container, bags_dir, directory)
-        tree = ET.parse(os.path.join(path_bagsdirdirectory, 'MODS.xml'))
-        identifier = tree.find('{http://www.loc.gov/mods/v3}identifier').text
+        identifier = read_xml_fields(os.path.join(path_bagsdirdirectory, 'MODS.xml'), first = [mods_identifier])[mods_identifier]
         access_id_hand.write(identifier + '|')
         access_id_hand.write(path_bagsdirdirectory + '\n')
         access_count += 1
@@ -320,17 +1323,16 @@ def access_id_path():
 #between the MODS identifier recorded and checking to see if it matches the subdir name. If it does, it moved the access assets and metadata over
 def merge_access_preservation():
     print('----MERGING ACCESS AND PRESERVATION ASSETS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
-    access_id_hand = open(os.path.join(proj_path, 'access_ids.txt'), 'r')
+    access_id_hand = storage.open(os.path.join(proj_path, 'access_ids.txt'), 'r')
     access_id_list = access_id_hand.readlines()
     access_id_hand.close()
-    rep_acc = 'Representation_Access'
     file_count = 0
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
         if directory.startswith('bags_'):
             continue
@@ -341,184 +1343,466 @@ def merge_access_preservation():
                 identifier = access_info[0].strip()
                 path = access_info[1].strip()
                 if identifier == directory:
-                    for file in os.listdir(path = path):
-                        if file.endswith('.xml'):
-                            shutil.move(os.path.join(path, file), os.path.join(path_directory, file))
-                            file_count += 1
-                        else:
-                            file_name = file.split('.')[0]
-                            os.mkdir(os.path.join(path_directory, rep_acc, file_name))
-                            shutil.move(os.path.join(path, file), os.path.join(path_directory, rep_acc, file_name, file))
-                            file_count += 1
+                    file_count += merge_access_files(path, path_directory)
     print('Moved {} access and metadata files'.format(file_count))
 
+#moves the access assets and metadata of a single processed bag into the matching asset directory in "container"
+#returns the number of files moved
+def merge_access_files(path, path_directory):
+    rep_acc = 'Representation_Access'
+    file_count = 0
+    for file in storage.listdir(path):
+        if file.endswith('.xml'):
+            resume_move(os.path.join(path, file), os.path.join(path_directory, file))
+            file_count += 1
+        else:
+            file_name = file.split('.')[0]
+            storage.makedirs(os.path.join(path_directory, rep_acc, file_name), exist_ok = True)
+            resume_move(os.path.join(path, file), os.path.join(path_directory, rep_acc, file_name, file))
+            file_count += 1
+    return file_count
+
 #this funciton simply removes the "bags_dir" folder path as well as deleting the "access_ids.txt" file
 def cleanup_bags():
     print('----CLEANING UP BAGS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     bags_dir = vars[2].strip()
-    shutil.rmtree(os.path.join(proj_path, container, bags_dir))
-    os.remove('access_ids.txt')
+    storage.rmtree(os.path.join(proj_path, container, bags_dir))
+    storage.remove(os.path.join(proj_path, 'access_ids.txt'))
     print('Deleted "{}" directory and access_ids.txt'.format(bags_dir))
 
 #this function stages the "Representation_Access" and "Representation_Preservation" folders for each asset inside a new directory
 #this facilitates the creation of the zipped PAX package in the following function
 def stage_pax_content():
     print('----STAGING PAX CONTENT IN PAX_STAGE----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     container = vars[1].strip()
     project_log_hand.close()
     pax_count = 0
     rep_count = 0
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
-        path_paxstage = os.path.join(proj_path, container, directory, 'pax_stage')
-        os.mkdir(path_paxstage)
+        stage_pax_asset(path_directory)
         pax_count += 1
-        shutil.move(os.path.join(path_directory, 'Representation_Access'), path_paxstage)
-        shutil.move(os.path.join(path_directory, 'Representation_Preservation'), path_paxstage)
         rep_count += 2
         print('created /pax_stage in {}'.format(directory))
     print('Created {} pax_stage subdirectories and staged {} representation subdirectories'.format(pax_count, rep_count))
 
+#moves the representation folders of a single asset directory into its "pax_stage" folder
+def stage_pax_asset(path_directory):
+    path_paxstage = os.path.join(path_directory, 'pax_stage')
+    storage.makedirs(path_paxstage, exist_ok = True)
+    for rep_dir in ['Representation_Access', 'Representation_Preservation']:
+        resume_move(os.path.join(path_directory, rep_dir), os.path.join(path_paxstage, rep_dir))
+
+#moves "src" to "dst" so that the move can be made again after an interrupted run: if "src" is gone and "dst" exists the move has already been made,
+#and if both exist "dst" is what is left of a copy between drives that was cut short, so it is removed and the move is made again
+#returns True if anything was moved
+def resume_move(src, dst):
+    if not storage.exists(src):
+        if storage.exists(dst):
+            return False
+        raise FileNotFoundError(src)
+    if storage.isdir(dst):
+        storage.rmtree(dst)
+    elif storage.exists(dst):
+        storage.remove(dst)
+    storage.move(src, dst)
+    return True
+
 #this function takes the contents of the "pax_stage" folder created in the previous function and writes them into a zip archive
 #the zip archive is the PAX object that will eventually become an Asset in Preservica
+#with pax_hash_while_writing the SHA-1 for pax_metadata() is calculated while the archive is written, which saves reading each archive back, but the CRC-32
+#has to be known before a member's data is written, so every file over "pax_chunk_size" is read twice (from the disk again if it is larger than the page cache)
+#ZipFile writes each file in one pass and pax_metadata() then reads the archive back, so both ways read about twice the data for archives of large files
 def create_pax():
     print('----CREATING PAX ZIP ARCHIVES----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     container = vars[1].strip()
     project_log_hand.close()
     dir_count = 0
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
-        path_zipdir = os.path.join(proj_path, container, directory, 'pax_stage/')
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
-        zip_dir = pathlib.Path(path_zipdir)
-        pax_obj = ZipFile(os.path.join(path_directory, directory + '.zip'), 'w')
-        for file_path in zip_dir.rglob("*"):
-            pax_obj.write(file_path, arcname = file_path.relative_to(zip_dir))
-        pax_obj.close()
-        os.rename(os.path.join(path_directory, directory + '.zip'), os.path.join(path_directory, directory + '.pax.zip'))
+        create_pax_asset(path_directory)
         dir_count += 1
         print('created {}'.format(str(dir_count) + ': ' + directory + '.pax.zip'))
-    print('Created {} PAX archives for ingest'.format(dir_count))    
-    
+    print('Created {} PAX archives for ingest'.format(dir_count))
+
+#writes the "pax_stage" folder of a single asset directory into "<directory>.pax.zip"
+def create_pax_asset(path_directory):
+    from zipfile import ZipFile
+    directory = basename(path_directory)
+    zip_dir = os.path.join(path_directory, 'pax_stage')
+    path_sha1 = os.path.join(path_directory, directory + '.pax.zip.sha1')
+    if pax_hash_while_writing:
+        sha1_checksum = write_pax_stored(os.path.join(path_directory, directory + '.zip'), zip_dir)
+        #kept beside the archive for pax_metadata(), which removes it
+        sha1_hand = storage.open(path_sha1, 'w')
+        sha1_hand.write('{} {}'.format(sha1_checksum, storage.stat(os.path.join(path_directory, directory + '.zip')).st_size))
+        sha1_hand.close()
+    else:
+        if storage.exists(path_sha1):
+            storage.remove(path_sha1)
+        zip_hand = storage.open(os.path.join(path_directory, directory + '.zip'), 'wb')
+        pax_obj = ZipFile(zip_hand, 'w')
+        for file_path in storage.walk(zip_dir):
+            write_zip_member(pax_obj, file_path, os.path.relpath(file_path, zip_dir))
+        pax_obj.close()
+        zip_hand.close()
+    storage.replace(os.path.join(path_directory, directory + '.zip'), os.path.join(path_directory, directory + '.pax.zip'))
+
+#adds a file or directory to an open ZipFile, reading it through "storage" (the equivalent of ZipFile.write for any storage backend)
+def write_zip_member(pax_obj, file_path, arcname):
+    import zipfile
+    st = storage.stat(file_path)
+    is_dir = stat.S_ISDIR(st.st_mode)
+    arcname = arcname.replace(os.sep, '/')
+    if is_dir:
+        arcname += '/'
+    date_time = time.localtime(st.st_mtime)[0:6]
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    if is_dir:
+        zinfo.external_attr |= 0x10
+        pax_obj.writestr(zinfo, b'')
+    else:
+        zinfo.file_size = st.st_size
+        file_hand = storage.open(file_path, 'rb')
+        member_hand = pax_obj.open(zinfo, 'w', force_zip64 = st.st_size > zipfile.ZIP64_LIMIT)
+        shutil.copyfileobj(file_hand, member_hand, pax_chunk_size)
+        member_hand.close()
+        file_hand.close()
+
+#this function writes a PAX zip archive of "zip_dir" with every member stored (the same layout ZipFile produces by default) and returns the SHA-1 of the archive
+#the CRC-32 of each member has to be in its local header before the data (Java zip readers refuse stored members that use data descriptors), so each source file
+#is read twice: once to calculate the CRC-32 and once to copy it into the archive (through a memory map of the file where it has a file descriptor)
+#the second read comes from the page cache unless the file is larger than the free memory, and members up to "pax_chunk_size" are only read once
+#every byte written is added to the archive's SHA-1 as it is written, so pax_metadata() does not have to read the archive back
+#Zip64 extra fields and end records are written for members over 2 GB and archives over 4 GB
+def write_pax_stored(path_zip, zip_dir):
+    central_dir = []
+    pax_hand = HashingFile(storage.open(path_zip, 'wb'), 'sha1')
+    try:
+        for file_path in storage.walk(zip_dir):
+            arcname = os.path.relpath(file_path, zip_dir).replace(os.sep, '/')
+            st = storage.stat(file_path)
+            is_dir = storage.isdir(file_path)
+            if is_dir:
+                arcname += '/'
+                size = 0
+            else:
+                size = st.st_size
+            central_dir.append(write_pax_member(pax_hand, file_path, arcname, st, size, is_dir))
+        write_pax_central_dir(pax_hand, central_dir)
+    finally:
+        pax_hand.close()
+    return pax_hand.hexdigest()
+
+#an archive opened for writing that hashes every byte written to it and keeps track of its own position
+class HashingFile:
+
+    def __init__(self, file_hand, algorithm):
+        self.file_hand = file_hand
+        self.file_hash = hashlib.new(algorithm)
+        self.position = 0
+
+    def write(self, data):
+        self.file_hash.update(data)
+        self.file_hand.write(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def hexdigest(self):
+        return self.file_hash.hexdigest()
+
+    def close(self):
+        self.file_hand.close()
+
+#writes a single stored member into the open archive and returns the information needed for its central directory record
+def write_pax_member(pax_hand, file_path, arcname, st, size, is_dir):
+    import zipfile
+    offset = pax_hand.tell()
+    date_time = time.localtime(st.st_mtime)[0:6]
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    dos_time = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+    dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    try:
+        name = arcname.encode('ascii')
+        flag_bits = 0
+    except UnicodeEncodeError:
+        name = arcname.encode('utf-8')
+        flag_bits = 0x800
+    zip64 = size > zipfile.ZIP64_LIMIT
+    version = zipfile.ZIP64_VERSION if zip64 else zipfile.DEFAULT_VERSION
+    if zip64:
+        extra = struct.pack('<HHQQ', 1, 16, size, size)
+        header_size = 0xFFFFFFFF
+    else:
+        extra = b''
+        header_size = size
+    crc = 0
+    file_hand = storage.open(file_path, 'rb') if size > 0 else None
+    try:
+        if size > pax_chunk_size:
+            for chunk in read_pax_chunks(file_hand, size):
+                crc = zlib.crc32(chunk, crc)
+        elif size > 0:
+            data = file_hand.read(size)
+            if len(data) != size:
+                raise OSError('{} changed size while it was being copied'.format(file_path))
+            crc = zlib.crc32(data)
+        header = struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader, version, 0, flag_bits, zipfile.ZIP_STORED, dos_time, dos_date, crc, header_size, header_size, len(name), len(extra))
+        pax_hand.write(header + name + extra)
+        if size > pax_chunk_size:
+            for chunk in read_pax_chunks(file_hand, size):
+                pax_hand.write(chunk)
+        elif size > 0:
+            pax_hand.write(data)
+    finally:
+        if file_hand is not None:
+            file_hand.close()
+    external_attr = (st.st_mode & 0xFFFF) << 16
+    if is_dir:
+        external_attr |= 0x10
+    return (name, flag_bits, dos_time, dos_date, crc, size, external_attr, offset)
+
+#yields the "size" bytes of the source file in chunks of "pax_chunk_size", as views of a memory map of the file where it has a file descriptor
+#otherwise (MemoryStorage, or files metered by ThrottledStorage) through a single reused buffer, each chunk is only valid until the next one is read
+def read_pax_chunks(file_hand, size):
+    import mmap
+    file_hand.seek(0)
+    try:
+        pax_map = mmap.mmap(file_hand.fileno(), 0, access = mmap.ACCESS_READ)
+    except (AttributeError, io.UnsupportedOperation):
+        pax_map = None
+    if pax_map is not None:
+        try:
+            if len(pax_map) != size:
+                raise OSError('{} changed size while it was being copied'.format(file_hand.name))
+            view = memoryview(pax_map)
+            try:
+                for chunk_start in range(0, size, pax_chunk_size):
+                    chunk = view[chunk_start:chunk_start + pax_chunk_size]
+                    try:
+                        yield chunk
+                    finally:
+                        chunk.release()
+            finally:
+                view.release()
+        finally:
+            pax_map.close()
+        return
+    buffer = bytearray(pax_chunk_size)
+    view = memoryview(buffer)
+    remaining = size
+    while remaining > 0:
+        read = file_hand.readinto(view[:min(pax_chunk_size, remaining)])
+        if read == 0:
+            raise OSError('unexpected end of file copying {}'.format(file_hand.name))
+        yield view[:read]
+        remaining -= read
+
+#writes the central directory and end of central directory records, switching to the Zip64 end records when the archive needs them
+def write_pax_central_dir(pax_hand, central_dir):
+    import zipfile
+    create_system = 0 if sys.platform == 'win32' else 3
+    start_dir = pax_hand.tell()
+    for name, flag_bits, dos_time, dos_date, crc, size, external_attr, offset in central_dir:
+        extra_data = []
+        if size > zipfile.ZIP64_LIMIT:
+            extra_data += [size, size]
+            header_size = 0xFFFFFFFF
+        else:
+            header_size = size
+        if offset > zipfile.ZIP64_LIMIT:
+            extra_data.append(offset)
+            header_offset = 0xFFFFFFFF
+        else:
+            header_offset = offset
+        if extra_data:
+            extra = struct.pack('<HH' + 'Q' * len(extra_data), 1, 8 * len(extra_data), *extra_data)
+            version = zipfile.ZIP64_VERSION
+        else:
+            extra = b''
+            version = zipfile.DEFAULT_VERSION
+        record = struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, version, create_system, version, 0, flag_bits, zipfile.ZIP_STORED, dos_time, dos_date, crc, header_size, header_size, len(name), len(extra), 0, 0, 0, external_attr, header_offset)
+        pax_hand.write(record + name + extra)
+    end_dir = pax_hand.tell()
+    count = len(central_dir)
+    size_dir = end_dir - start_dir
+    if count > zipfile.ZIP_FILECOUNT_LIMIT or start_dir > zipfile.ZIP64_LIMIT or size_dir > zipfile.ZIP64_LIMIT:
+        zip64_end = struct.pack(zipfile.structEndArchive64, zipfile.stringEndArchive64, 44, zipfile.ZIP64_VERSION, zipfile.ZIP64_VERSION, 0, 0, count, count, size_dir, start_dir)
+        zip64_locator = struct.pack(zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator, 0, end_dir, 1)
+        pax_hand.write(zip64_end + zip64_locator)
+        count = min(count, 0xFFFF)
+        size_dir = min(size_dir, 0xFFFFFFFF)
+        start_dir = min(start_dir, 0xFFFFFFFF)
+    pax_hand.write(struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, count, count, size_dir, start_dir, 0))
+
+#calculates the SHA-1 checksum of a file in large chunks rather than reading the whole file into memory
+def sha1_file(path):
+    return hash_file(path, 'sha1')
+
+#calculates the checksum of a file with any hashlib algorithm, in chunks of "pax_chunk_size"
+def hash_file(path, algorithm):
+    file_hash = hashlib.new(algorithm)
+    file_hand = storage.open(path, 'rb')
+    try:
+        buffer = bytearray(pax_chunk_size)
+        view = memoryview(buffer)
+        while True:
+            read = file_hand.readinto(buffer)
+            if read == 0:
+                break
+            file_hash.update(view[:read])
+    finally:
+        file_hand.close()
+    return file_hash.hexdigest()
+
 #this function uses regex to remove the XML header from any metadata files before they are merged into a single OPEX file
 #extra XML headers will cause the OPEX Incremental Workflow to fail when trying to ingest
 def cleanup_metadata():
     print('----REMOVING EXTRA XML HEADERS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     header_count = 0
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
-        for file in os.listdir(path = path_directory):
-            if file.endswith('.xml'):
-                temp_hand = open(os.path.join(path_directory, file), 'r')
-                md_file = temp_hand.read()
-                temp_hand.close()
-                xml_header = re.findall('<\?.+\?>', md_file)
-                if len(xml_header) > 0:
-                    xml_header = xml_header[0]
-                    new_md_file = md_file.replace(xml_header, '')
-                    temp_hand = open(os.path.join(path_directory, file), 'w')
-                    temp_hand.write(new_md_file)
-                    temp_hand.close()
-                    header_count += 1
-                    print('removing XML header from {} in {}'.format(file, directory))
+        header_count += cleanup_metadata_asset(path_directory)
     print('Removed {} extra XML headers from metadata files'.format(header_count))
 
+#removes the XML header from each metadata file in a single asset directory
+#returns the number of headers removed
+def cleanup_metadata_asset(path_directory):
+    directory = basename(path_directory)
+    header_count = 0
+    for file in storage.listdir(path_directory):
+        if file.endswith('.xml'):
+            temp_hand = storage.open(os.path.join(path_directory, file), 'r')
+            md_file = temp_hand.read()
+            temp_hand.close()
+            xml_header = re.findall('<\?.+\?>', md_file)
+            if len(xml_header) > 0:
+                xml_header = xml_header[0]
+                new_md_file = md_file.replace(xml_header, '')
+                temp_hand = storage.open(os.path.join(path_directory, file), 'w')
+                temp_hand.write(new_md_file)
+                temp_hand.close()
+                header_count += 1
+                print('removing XML header from {} in {}'.format(file, directory))
+    return header_count
+
 #this function creates the OPEX metadata file that accompanies an individual zipped PAX package
 #this includes all the identifiers from the DC metadata file as well as the full MODS and DC records themselves
 #this function also includes the metadata necessary for ArchivesSpace sync to Preservica
 def pax_metadata():
     print('---CREATING METADATA FILES FOR PAX OBJECTS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     dir_count = 0
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
         try:
-            pax_hand = open(os.path.join(path_directory, directory + '.pax.zip'), 'rb')
-            pax_read = pax_hand.read()
-            sha1_checksum = hashlib.sha1(pax_read).hexdigest()
-            opex1 = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><opex:OPEXMetadata xmlns:opex="http://www.openpreservationexchange.org/opex/v1.0"><opex:Transfer><opex:Fixities><opex:Fixity type="SHA-1" value="' + sha1_checksum + '"/></opex:Fixities></opex:Transfer><opex:Properties><opex:Title>'
-            pax_hand.close()
-            tree = ET.parse(os.path.join(path_directory, 'DC.xml'))
-            root = tree.getroot()
-            opex2 = tree.find('{http://purl.org/dc/elements/1.1/}title').text
-            opex3 = '</opex:Title><opex:Identifiers>'
-            id_list = []
-            opex4 = ''
-            for id in root.findall('{http://purl.org/dc/elements/1.1/}identifier'):
-                id_list.append(id.text)
-            for item in id_list:
-                if item.startswith('ur'):
-                    opex4 += '<opex:Identifier type="code">' + item + '</opex:Identifier>'
-                else:
-                    other_identifiers = item.split(':')
-                    label = other_identifiers[0].strip()
-                    value = other_identifiers[1].strip()
-                    opex4 += '<opex:Identifier type="' + label + '">' + value + '</opex:Identifier>'
-            opex5 = '</opex:Identifiers></opex:Properties><opex:DescriptiveMetadata><LegacyXIP xmlns="http://preservica.com/LegacyXIP"><AccessionRef>catalogue</AccessionRef></LegacyXIP>'
-            opex6 = ''
-            for file in os.listdir(path = path_directory):
-                if file.endswith('.xml'):
-                    temp_file_hand = open(os.path.join(path_directory, file), 'r')
-                    metadata = temp_file_hand.read().strip()
-                    opex6 += metadata + '\n'
-                    temp_file_hand.close()
-            opex7 = '</opex:DescriptiveMetadata></opex:OPEXMetadata>'
-            filename = directory + '.pax.zip.opex'
-            pax_md_hand = open(os.path.join(path_directory, filename), 'a')
-            pax_md_hand.write(opex1 + opex2 + opex3 + opex4 + opex5 + opex6 + opex7)
-            pax_md_hand.close()
-            print('created {}'.format(filename))
+            pax_metadata_asset(path_directory)
             dir_count += 1
         except:
             print('ERROR: {}'.format(directory))
     print('Created {} OPEX metdata files for individual assets'.format(dir_count))
+
+#returns the SHA-1 of the asset's PAX archive, taken from the ".pax.zip.sha1" file written by write_pax_stored() if there is one for this archive,
+#otherwise by reading the archive
+def pax_sha1(path_directory, directory):
+    path_pax = os.path.join(path_directory, directory + '.pax.zip')
+    path_sha1 = path_pax + '.sha1'
+    if not storage.exists(path_sha1):
+        return sha1_file(path_pax)
+    sha1_hand = storage.open(path_sha1, 'r')
+    sha1_checksum, size = sha1_hand.read().split()
+    sha1_hand.close()
+    storage.remove(path_sha1)
+    if int(size) != storage.stat(path_pax).st_size:
+        return sha1_file(path_pax)
+    return sha1_checksum
+
+#writes the OPEX metadata file for the PAX archive of a single asset directory
+def pax_metadata_asset(path_directory):
+    directory = basename(path_directory)
+    sha1_checksum = pax_sha1(path_directory, directory)
+    opex1 = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><opex:OPEXMetadata xmlns:opex="http://www.openpreservationexchange.org/opex/v1.0"><opex:Transfer><opex:Fixities><opex:Fixity type="SHA-1" value="' + sha1_checksum + '"/></opex:Fixities></opex:Transfer><opex:Properties><opex:Title>'
+    dc_fields = read_xml_fields(os.path.join(path_directory, 'DC.xml'), first = [dc_title], every = [dc_identifier])
+    opex2 = dc_fields[dc_title]
+    opex3 = '</opex:Title><opex:Identifiers>'
+    id_list = dc_fields[dc_identifier]
+    opex4 = ''
+    for item in id_list:
+        if item.startswith('ur'):
+            opex4 += '<opex:Identifier type="code">' + item + '</opex:Identifier>'
+        else:
+            other_identifiers = item.split(':')
+            label = other_identifiers[0].strip()
+            value = other_identifiers[1].strip()
+            opex4 += '<opex:Identifier type="' + label + '">' + value + '</opex:Identifier>'
+    opex5 = '</opex:Identifiers></opex:Properties><opex:DescriptiveMetadata><LegacyXIP xmlns="http://preservica.com/LegacyXIP"><AccessionRef>catalogue</AccessionRef></LegacyXIP>'
+    opex6 = ''
+    for file in storage.listdir(path_directory):
+        if file.endswith('.xml'):
+            temp_file_hand = storage.open(os.path.join(path_directory, file), 'r')
+            metadata = temp_file_hand.read().strip()
+            opex6 += metadata + '\n'
+            temp_file_hand.close()
+    opex7 = '</opex:DescriptiveMetadata></opex:OPEXMetadata>'
+    filename = directory + '.pax.zip.opex'
+    pax_md_hand = storage.open(os.path.join(path_directory, filename), 'w')
+    pax_md_hand.write(opex1 + opex2 + opex3 + opex4 + opex5 + opex6 + opex7)
+    pax_md_hand.close()
+    print('created {}'.format(filename))
     
 #this function deletes many files and folders that have now served their purpose in the migration process
 #all metadata files are deleted as well as the "pax_stage" folder and it's contents
 #a warning is thrown up and directory and file name information written to "project_log.txt" if an unexpected file is discovered
 def cleanup_directories():
     print('----REMOVING UNNECESSARY FILES----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     file_count = 0
     dir_count = 0
     unexpected = 0
-    project_log_hand = open(proj_log_file, 'a')
+    project_log_hand = storage.open(proj_log_file, 'a')
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
-        for entity in os.listdir(path = path_directory):
+        for entity in storage.listdir(path_directory):
             path_entity = os.path.join(proj_path, container, directory, entity)
             if entity.endswith('.zip') == True:
                 print('PAX: ' + entity)
             elif entity.endswith('.opex') == True:
                 print('metadata: ' + entity)
             elif entity.endswith('.xml') == True:
-                os.remove(path_entity)
+                storage.remove(path_entity)
                 file_count += 1
                 print('removed metadata file')
             elif entity == 'pax_stage':
-                shutil.rmtree(path_entity)
+                storage.rmtree(path_entity)
                 dir_count += 1
                 print('removed pax_stage directory')
             else:
@@ -535,60 +1819,207 @@ def cleanup_directories():
 #this metadata is another facet required for ArchivesSpace to Preservica synchronization
 def ao_opex_metadata():
     print('----CREATE ARCHIVAL OBJECT OPEX METADATA----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     container = vars[1].strip()
     project_log_hand.close()
     file_count = 0
-    id_hand = open(os.path.join(proj_path, 'perkins-gillman_aonum_islid.txt'), 'r')
+    id_hand = storage.open(os.path.join(proj_path, 'perkins-gillman_aonum_islid.txt'), 'r')
     id_list = id_hand.readlines()
     id_hand.close()
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    batch = MetadataBatch()
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
         if directory.startswith('archival_object_'):
             continue
         else:
-            try:
-                opex_hand = open(os.path.join(path_directory, directory + '.pax.zip.opex'), 'r')
-                opex_str = opex_hand.read()
-                opex_hand.close()
-                ao_num = ''
-                for line in id_list:
-                    ids = line.split('|')
-                    aonum = ids[0].strip()
-                    isnum = ids[1].strip()
-                    if opex_str.find(isnum) != -1:
-                        ao_num = aonum
-                        print('found a match for {} and {}'.format(aonum, isnum))
-                opex = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><opex:OPEXMetadata xmlns:opex="http://www.openpreservationexchange.org/opex/v1.0"><opex:Properties><opex:Title>' + ao_num + '</opex:Title><opex:Identifiers><opex:Identifier type="code">' + ao_num + '</opex:Identifier></opex:Identifiers></opex:Properties><opex:DescriptiveMetadata><LegacyXIP xmlns="http://preservica.com/LegacyXIP"><Virtual>false</Virtual></LegacyXIP></opex:DescriptiveMetadata></opex:OPEXMetadata>'
-                ao_md_hand = open(os.path.join(path_directory, ao_num + '.opex'), 'w')
-                ao_md_hand.write(opex)
-                ao_md_hand.close()
-                os.rename(path_directory, os.path.join(proj_path, container, ao_num))
-                file_count += 1
-            except:
-                print('error: {}'.format(directory))
-    print('Created {} archival object metadata files'.format(file_count))
+            batch.call(ao_opex_asset, (path_directory, id_list), [path_directory], 'created archival object metadata for {}'.format(directory))
+            file_count += 1
+    errors = batch.run()
+    print('Created {} archival object metadata files'.format(file_count - len(errors)))
+    return not errors
+
+#writes the archival object OPEX metadata for a single asset directory, then renames the directory to the archival object number
+def ao_opex_asset(path_directory, id_list):
+    directory = basename(path_directory)
+    opex_hand = storage.open(os.path.join(path_directory, directory + '.pax.zip.opex'), 'r')
+    opex_str = opex_hand.read()
+    opex_hand.close()
+    ao_num = ''
+    for line in id_list:
+        ids = line.split('|')
+        aonum = ids[0].strip()
+        isnum = ids[1].strip()
+        if opex_str.find(isnum) != -1:
+            ao_num = aonum
+            print('found a match for {} and {}'.format(aonum, isnum))
+    opex = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><opex:OPEXMetadata xmlns:opex="http://www.openpreservationexchange.org/opex/v1.0"><opex:Properties><opex:Title>' + ao_num + '</opex:Title><opex:Identifiers><opex:Identifier type="code">' + ao_num + '</opex:Identifier></opex:Identifiers></opex:Properties><opex:DescriptiveMetadata><LegacyXIP xmlns="http://preservica.com/LegacyXIP"><Virtual>false</Virtual></LegacyXIP></opex:DescriptiveMetadata></opex:OPEXMetadata>'
+    ao_md_hand = storage.open(os.path.join(path_directory, ao_num + '.opex'), 'w')
+    ao_md_hand.write(opex)
+    ao_md_hand.close()
+    storage.rename(path_directory, os.path.join(os.path.dirname(path_directory), ao_num))
 
 #this function creates the last OPEX metadata file required for the OPEX incremental ingest, for the container folder
 #this OPEX file has the folder manifest to ensure that content is ingested properly
 def write_opex_container_md():
     print('----CREATE CONTAINER OBJECT OPEX METADATA----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     opex1 = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><opex:OPEXMetadata xmlns:opex="http://www.openpreservationexchange.org/opex/v1.0"><opex:Transfer><opex:Manifest><opex:Folders>'
     opex2 = ''
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    for directory in storage.listdir(path_container):
         opex2 += '<opex:Folder>' + directory + '</opex:Folder>'
     opex3 = '</opex:Folders></opex:Manifest></opex:Transfer></opex:OPEXMetadata>'
-    container_opex_hand = open(os.path.join(proj_path, container, container + '.opex'), 'w')
+    container_opex_hand = storage.open(os.path.join(proj_path, container, container + '.opex'), 'w')
     container_opex_hand.write(opex1 + opex2 + opex3)
     print('Created OPEX metadata file for {} directory'.format(container))
     container_opex_hand.close()
+
+#this function checks the finished container before it is uploaded: for every "<asset>.pax.zip.opex" it recomputes the SHA-1 of the PAX archive and compares
+#it to the fixity recorded in the OPEX, and checks every member against the CRC-32 in the zip central directory
+#archives are read in chunks on "workers" threads, and with "incremental" only assets whose PAX or OPEX changed since the last audit (or that failed it) are checked again
+#the results are written to "fixity_audit.json" in the project folder
+def audit_container(workers = 4, incremental = True):
+    import concurrent.futures
+    import json
+    print('----AUDITING PAX FIXITY----')
+    project_log_hand = storage.open(proj_log_file, 'r')
+    vars = project_log_hand.readlines()
+    project_log_hand.close()
+    container = vars[1].strip()
+    path_container = os.path.join(proj_path, container)
+    path_report = os.path.join(proj_path, 'fixity_audit.json')
+    previous = dict()
+    if incremental and storage.exists(path_report):
+        report_hand = storage.open(path_report, 'r')
+        previous = dict((result['opex'], result) for result in json.load(report_hand)['assets'])
+        report_hand.close()
+    opex_list = [path for path in storage.walk(path_container) if path.endswith('.pax.zip.opex')]
+    results = []
+    to_audit = []
+    for path_opex in opex_list:
+        result = previous.get(os.path.relpath(path_opex, path_container).replace(os.sep, '/'))
+        if result is not None and result['status'] == 'pass' and result['signature'] == audit_signature(path_opex):
+            results.append(result)
+        else:
+            to_audit.append(path_opex)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+    try:
+        for result in pool.map(lambda path_opex: audit_pax(path_opex, path_container), to_audit):
+            print('{}: {}{}'.format(result['status'].upper(), result['opex'], ' | ' + result['error'] if result['error'] else ''))
+            results.append(result)
+    finally:
+        pool.shutdown(wait = True)
+    results.sort(key = lambda result: result['opex'])
+    failed = len([result for result in results if result['status'] != 'pass'])
+    report = {'container': container, 'audited': datetime.now().strftime('%Y-%m-%d_%H-%M-%S'), 'checked': len(to_audit), 'unchanged': len(results) - len(to_audit), 'passed': len(results) - failed, 'failed': failed, 'assets': results}
+    report_hand = storage.open(path_report, 'w')
+    json.dump(report, report_hand, indent = 1)
+    report_hand.close()
+    print('Audited {} PAX archives ({} unchanged since the last audit) | {} passed | {} failed'.format(len(results), report['unchanged'], report['passed'], failed))
+    return failed == 0
+
+#size and modification time of a PAX archive and its OPEX, used to tell whether they have changed since the last audit
+def audit_signature(path_opex):
+    signature = []
+    for path in (path_opex[:-len('.opex')], path_opex):
+        try:
+            st = storage.stat(path)
+            signature += [st.st_size, st.st_mtime]
+        except FileNotFoundError:
+            signature += [None, None]
+    return signature
+
+#audits a single PAX archive against its OPEX, returning a dict for the report
+#any error reading or checking the archive fails this asset only, so one bad archive cannot stop the audit or its report
+def audit_pax(path_opex, path_container):
+    path_pax = path_opex[:-len('.opex')]
+    result = {'opex': os.path.relpath(path_opex, path_container).replace(os.sep, '/'), 'signature': None, 'expected_sha1': None, 'sha1': None, 'bad_members': [], 'status': 'fail', 'error': ''}
+    try:
+        result['signature'] = audit_signature(path_opex)
+        opex_hand = storage.open(path_opex, 'rb')
+        tree = ET.parse(opex_hand)
+        opex_hand.close()
+        fixity = tree.find('.//{http://www.openpreservationexchange.org/opex/v1.0}Fixity[@type="SHA-1"]')
+        if fixity is None:
+            result['error'] = 'no SHA-1 fixity in OPEX'
+            return result
+        if not fixity.get('value'):
+            result['error'] = 'SHA-1 fixity in OPEX has no value'
+            return result
+        result['expected_sha1'] = fixity.get('value').lower()
+        result['sha1'], result['bad_members'] = check_pax(path_pax)
+    except Exception as err:
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+        return result
+    if result['sha1'] != result['expected_sha1']:
+        result['error'] = 'SHA-1 does not match OPEX'
+    elif result['bad_members']:
+        result['error'] = 'CRC-32 does not match for {} members'.format(len(result['bad_members']))
+    else:
+        result['status'] = 'pass'
+    return result
+
+#reads a PAX archive once in chunks of "pax_chunk_size", calculating its SHA-1 and the CRC-32 of each stored member as it goes
+#members that are not stored (compressed by another tool) are checked afterwards by reading them through ZipFile
+#returns the SHA-1 and the names of the members whose CRC-32 does not match the central directory
+def check_pax(path_pax):
+    import zipfile
+    from zipfile import ZipFile
+    pax_hand = storage.open(path_pax, 'rb')
+    try:
+        pax_obj = ZipFile(pax_hand)
+        members = []
+        compressed = []
+        for zinfo in pax_obj.infolist():
+            if zinfo.compress_type != zipfile.ZIP_STORED:
+                compressed.append(zinfo)
+                continue
+            pax_hand.seek(zinfo.header_offset)
+            header = struct.unpack(zipfile.structFileHeader, pax_hand.read(zipfile.sizeFileHeader))
+            if header[0] != zipfile.stringFileHeader:
+                raise zipfile.BadZipFile('bad local header for {}'.format(zinfo.filename))
+            start = zinfo.header_offset + zipfile.sizeFileHeader + header[10] + header[11]
+            members.append([start, start + zinfo.compress_size, zinfo, 0])
+        members.sort(key = lambda member: member[0])
+        sha1 = hashlib.sha1()
+        buffer = bytearray(pax_chunk_size)
+        view = memoryview(buffer)
+        pax_hand.seek(0)
+        pos = 0
+        first = 0
+        while True:
+            read = pax_hand.readinto(buffer)
+            if not read:
+                break
+            sha1.update(view[:read])
+            chunk_end = pos + read
+            index = first
+            while index < len(members) and members[index][0] < chunk_end:
+                start, end = members[index][0], members[index][1]
+                if max(start, pos) < min(end, chunk_end):
+                    members[index][3] = zlib.crc32(view[max(start, pos) - pos:min(end, chunk_end) - pos], members[index][3])
+                index += 1
+            while first < len(members) and members[first][1] <= chunk_end:
+                first += 1
+            pos = chunk_end
+        bad_members = [member[2].filename for member in members if member[3] != member[2].CRC]
+        for zinfo in compressed:
+            try:
+                member_hand = pax_obj.open(zinfo)
+                while member_hand.read(pax_chunk_size):
+                    pass
+                member_hand.close()
+            except zipfile.BadZipFile:
+                bad_members.append(zinfo.filename)
+        pax_obj.close()
+    finally:
+        pax_hand.close()
+    return sha1.hexdigest(), bad_members
     
 #------------------------------------------------------------------------------------------------------------------------------------------------------
 # WORKFLOW FOR PREPARING ASSETS FOR PRESERVICA INGEST
@@ -610,6 +2041,8 @@ def write_opex_container_md():
 # validate_bags()
 ## create_id_ss() - Create a spreadsheet with the mapping between preservation file names, access file names, and bag ids
 # create_id_ss()
+## find_duplicates() - Report preservation and access files with identical content so they can be rectified before packaging (link = True replaces copies with hard links)
+# find_duplicates()
 ## Manual Process - Rectify the mismatches presented in the pres_acc_bag_ids spreadsheet
 ## representation_preservation() - Create 'Representation_Preservation' subdirectories in each asset folder, then move preservation assets into them
 # representation_preservation()
@@ -628,6 +2061,7 @@ def write_opex_container_md():
 ## cleanup_metadata() - Removes excess XML headers from individual metadata files
 # cleanup_metadata()
 ## create_pax() - Make a PAX zip archive out of the Representation_Access and Representation_Preservation
+## set pax_hash_while_writing = True to calculate the SHA-1 of each PAX while it is written instead of reading it back in pax_metadata()
 # create_pax()
 ## pax_metadata() - Write the OPEX metadata for the individua assets contained in the PAX
 # pax_metadata()
@@ -637,6 +2071,8 @@ def write_opex_container_md():
 # ao_opex_metadata()
 ## write_opex_container_md() - Write the OPEX metadata for the entire container structure
 # write_opex_container_md()
+## audit_container() - Check every PAX archive against the SHA-1 in its OPEX and the CRC-32s in its central directory before upload
+# audit_container()
 #------------------------------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -647,37 +2083,40 @@ def write_opex_container_md():
 # renames the bags if necessary depending on project needs
 def rename_bags():
     print('----RENAMING BAGS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     num_bags = 0
     path_bagsdir = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_bagsdir):
+    batch = MetadataBatch()
+    for directory in storage.listdir(path_bagsdir):
         path_bagsdirdirectory = os.path.join(proj_path, container, directory)
         id_name = directory.split('-')[1].strip()
-        os.rename(path_bagsdirdirectory, os.path.join(path_bagsdir, id_name))
+        batch.rename(path_bagsdirdirectory, os.path.join(path_bagsdir, id_name), 'renamed {} into {}'.format(directory, id_name))
         num_bags += 1
-        print('renamed {} into {}'.format(directory, id_name))
-    print('renamed {} bags'.format(num_bags))
+    errors = batch.run()
+    print('renamed {} bags'.format(num_bags - len(errors)))
+    return not errors
     
 #possible alternative to process_bags(), reverting the bags as a separate function
 def revert_bags():
+    from bdbag import bdbag_api
     print('----RERVERTING BAGS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     bags_dir = vars[2].strip()
     num_bags = 0
-    error_log_handle = open(os.path.join(proj_path, 'validation_error_log.txt'), 'r')
+    error_log_handle = storage.open(os.path.join(proj_path, 'validation_error_log.txt'), 'r')
     error_log = error_log_handle.read()
     error_log_handle.close()
     error_log_str = ''
     for line in error_log:
         error_log_str = error_log_str + line
     path_bagsdir = os.path.join(proj_path, container, bags_dir)
-    for directory in os.listdir(path = path_bagsdir):
+    for directory in storage.listdir(path_bagsdir):
         path_bagsdirdirectory = os.path.join(proj_path, container, bags_dir, directory)
         #skips any directories that raised errors during validation
         if error_log_str.find(directory) != -1 :
@@ -693,13 +2132,13 @@ def revert_bags():
 #uses REGEX to identify a number of different file format extensions
 def process_bags_islandora():
     print('----PROCESSING BAGS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     num_bags = 0
     path_bagsdir = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_bagsdir):
+    for directory in storage.listdir(path_bagsdir):
         path_bagsdirdirectory = os.path.join(proj_path, container, directory)
         #skips any directories that raised errors during validation
         print('processing: {}'.format(directory))
@@ -707,40 +2146,37 @@ def process_bags_islandora():
         extension = ''
         #removes unnecessary files generated by Islandora
         unnecessary_files = ['foo.xml', 'foxml.xml', 'JP2.jp2', 'JPG.jpg', 'POLICY.xml', 'PREVIEW.jpg', 'RELS-EXT.rdf', 'RELS-INT.rdf', 'TN.jpg', 'HOCR.html', 'OCR.txt', 'PROXY_MP3.mp3', 'TIFF.tif']
-        for file in os.listdir(path = path_bagsdirdirectory):
+        for file in storage.listdir(path_bagsdirdirectory):
             if file in unnecessary_files:
-                os.remove(os.path.join(proj_path, container, directory, file))
-        for file in os.listdir(path = path_bagsdirdirectory):
+                storage.remove(os.path.join(proj_path, container, directory, file))
+        for file in storage.listdir(path_bagsdirdirectory):
             if re.search('^OBJ', file):
                 obj_file_name = file
                 extension = obj_file_name.split('.')[1].strip()
                 path_objfilename = os.path.join(proj_path, container, directory, obj_file_name)
-                #use xml.etree to identify filename from MODS.xml
-                tree = ET.parse(os.path.join(path_bagsdirdirectory, 'DC.xml'))
-                identifier = tree.find('{http://purl.org/dc/elements/1.1/}identifier').text
+                #identify filename from DC.xml
+                identifier = read_xml_fields(os.path.join(path_bagsdirdirectory, 'DC.xml'), first = [dc_identifier])[dc_identifier]
                 identifier = identifier.replace(':','_')
                 #rename the OBJ file to original filename pulled from MODS.xml
-                os.rename(path_objfilename, os.path.join(path_bagsdirdirectory, identifier + '.' + extension))
+                storage.rename(path_objfilename, os.path.join(path_bagsdirdirectory, identifier + '.' + extension))
             elif re.search('^FULL_TEXT', file):
                 obj_file_name = file
                 extension = obj_file_name.split('.')[1].strip()
                 path_objfilename = os.path.join(proj_path, container, directory, obj_file_name)
-                #use xml.etree to identify filename from MODS.xml
-                tree = ET.parse(os.path.join(path_bagsdirdirectory, 'DC.xml'))
-                identifier = tree.find('{http://purl.org/dc/elements/1.1/}identifier').text
+                #identify filename from DC.xml
+                identifier = read_xml_fields(os.path.join(path_bagsdirdirectory, 'DC.xml'), first = [dc_identifier])[dc_identifier]
                 identifier = identifier.replace(':','_')
                 #rename the OBJ file to original filename pulled from MODS.xml
-                os.rename(path_objfilename, os.path.join(path_bagsdirdirectory, identifier + '.' + extension))
+                storage.rename(path_objfilename, os.path.join(path_bagsdirdirectory, identifier + '.' + extension))
             elif re.search('^MP4', file):
                 obj_file_name = file
                 extension = obj_file_name.split('.')[1].strip()
                 path_objfilename = os.path.join(proj_path, container, directory, obj_file_name)
-                #use xml.etree to identify filename from MODS.xml
-                tree = ET.parse(os.path.join(path_bagsdirdirectory, 'DC.xml'))
-                identifier = tree.find('{http://purl.org/dc/elements/1.1/}identifier').text
+                #identify filename from DC.xml
+                identifier = read_xml_fields(os.path.join(path_bagsdirdirectory, 'DC.xml'), first = [dc_identifier])[dc_identifier]
                 identifier = identifier.replace(':','_')
                 #rename the OBJ file to original filename pulled from MODS.xml
-                os.rename(path_objfilename, os.path.join(path_bagsdirdirectory, identifier + '.' + extension))
+                storage.rename(path_objfilename, os.path.join(path_bagsdirdirectory, identifier + '.' + extension))
         num_bags += 1
     print('Processed {} bags'.format(str(num_bags)))
     
@@ -750,7 +2186,7 @@ def process_bags_islandora():
 #access copies and zero preservation representations
 def representation_preservation_access():
     print('----CREATING REPRESENTATION_ACCESS FOLDERS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
@@ -761,45 +2197,45 @@ def representation_preservation_access():
     rep_acc2 = 'Representation_Access_2'
     rep_pres = 'Representation_Preservation'
     path_container = os.path.join(proj_path, container)
-    for directory in os.listdir(path = path_container):
+    for directory in storage.listdir(path_container):
         path_directory = os.path.join(proj_path, container, directory)
         file_list = []
-        for file in os.listdir(path = path_directory):
+        for file in storage.listdir(path_directory):
             file_list.append(file)
         testvartext = directory + '.txt'
         testvarvideo = directory + '.mp4'
         if testvartext in file_list:
             path_diracc1 = os.path.join(proj_path, container, directory, rep_acc1)
-            os.mkdir(path_diracc1)
+            storage.mkdir(path_diracc1)
             path_diracc1_subdir = os.path.join(proj_path, container, directory, rep_acc1, directory)
-            os.mkdir(path_diracc1_subdir)
+            storage.mkdir(path_diracc1_subdir)
             path_diracc2 = os.path.join(proj_path, container, directory, rep_acc2)
-            os.mkdir(path_diracc2)
+            storage.mkdir(path_diracc2)
             path_diracc2_subdir = os.path.join(proj_path, container, directory, rep_acc2, directory)
-            os.mkdir(path_diracc2_subdir)
-            for file in os.listdir(path = path_directory):
+            storage.mkdir(path_diracc2_subdir)
+            for file in storage.listdir(path_directory):
                 if file.endswith('pdf'):
-                    shutil.move(os.path.join(path_directory, file), os.path.join(path_diracc1_subdir, file))
+                    storage.move(os.path.join(path_directory, file), os.path.join(path_diracc1_subdir, file))
                     file_count += 1
                 elif file.endswith('txt'):
-                    shutil.move(os.path.join(path_directory, file), os.path.join(path_diracc2_subdir, file))
+                    storage.move(os.path.join(path_directory, file), os.path.join(path_diracc2_subdir, file))
                     file_count += 1
             print('created {} and {}'.format(path_diracc1_subdir, path_diracc2_subdir))
         elif testvarvideo in file_list:
             path_diracc = os.path.join(proj_path, container, directory, rep_acc)
-            os.mkdir(path_diracc)
+            storage.mkdir(path_diracc)
             path_diracc_subdir = os.path.join(proj_path, container, directory, rep_acc, directory)
-            os.mkdir(path_diracc_subdir)
+            storage.mkdir(path_diracc_subdir)
             path_dirpres = os.path.join(proj_path, container, directory, rep_pres)
-            os.mkdir(path_dirpres)
+            storage.mkdir(path_dirpres)
             path_dirpres_subdir = os.path.join(proj_path, container, directory, rep_pres, directory)
-            os.mkdir(path_dirpres_subdir)
-            for file in os.listdir(path = path_directory):
+            storage.mkdir(path_dirpres_subdir)
+            for file in storage.listdir(path_directory):
                 if file.endswith('mp4'):
-                    shutil.move(os.path.join(path_directory, file), os.path.join(path_diracc_subdir, file))
+                    storage.move(os.path.join(path_directory, file), os.path.join(path_diracc_subdir, file))
                     file_count += 1
                 elif file.endswith('mov'):
-                    shutil.move(os.path.join(path_directory, file), os.path.join(path_dirpres_subdir, file))
+                    storage.move(os.path.join(path_directory, file), os.path.join(path_dirpres_subdir, file))
                     file_count += 1
             print('created {} and {}'.format(path_diracc_subdir, path_dirpres_subdir))
         folder_count += 1
@@ -848,14 +2284,14 @@ def representation_preservation_access():
 #particular resource
 def folder_ds_files_alt1():
     print('----CREATING FOLDER STRUCTURE FOR PRESERVATION MASTERS----')
-    project_log_hand = open(proj_log_file, 'r')
+    project_log_hand = storage.open(proj_log_file, 'r')
     vars = project_log_hand.readlines()
     project_log_hand.close()
     container = vars[1].strip()
     folder_name = ''
     folder_count = 0
     file_count = 0
-    id_list_hand = open('file_list.txt', 'r')
+    id_list_hand = storage.open('file_list.txt', 'r')
     id_list = id_list_hand.readlines()
     id_list_hand.close()
     for id in id_list:
@@ -863,13 +2299,13 @@ def folder_ds_files_alt1():
         print(id)
         id_comp = id.strip().split('-')
         if len(id_comp) == 2:
-            os.mkdir(os.path.join(proj_path, container, id))
+            storage.mkdir(os.path.join(proj_path, container, id))
             folder_count += 1
-            shutil.move(os.path.join(proj_path, container, id + '.tif'), os.path.join(proj_path, container, id, id + '.tif'))
+            storage.move(os.path.join(proj_path, container, id + '.tif'), os.path.join(proj_path, container, id, id + '.tif'))
             file_count += 1
         else:
             file_loc = os.path.join(proj_path, container, id)
-            os.mkdir(file_loc)
+            storage.mkdir(file_loc)
             folder_count += 1
             id_prefix = id_comp[0]
             id_start = int(id_comp[1])
@@ -882,8 +2318,592 @@ def folder_ds_files_alt1():
             for id in id_list:
                 id = str(id)
                 file_name = id_prefix + '-' + id.zfill(3) + '.tif'
-                shutil.move(os.path.join(proj_path, container, file_name), os.path.join(file_loc, file_name ))
+                storage.move(os.path.join(proj_path, container, file_name), os.path.join(file_loc, file_name ))
                 file_count += 1
     print('Created and renamed {} subdirectories and moved {} files into them'.format(folder_count, file_count))
 
 #folder_ds_files_alt1()
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# WATCH-FOLDER SERVICE MODE
+# Runs extract -> validate -> process -> merge -> PAX -> OPEX for each zipped bag as soon as it has finished copying into the bags directory
+# Assumes create_container(), folder_ds_files() and create_bags_dir() have been run, so asset directories exist in "container"
+# Stop the service with Ctrl+C, then run cleanup_directories(), ao_opex_metadata() and write_opex_container_md() as usual
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+
+#this function watches the bags directory and pushes each new zipped bag through the whole workflow on a bounded pool of worker threads
+#new bags are found with inotify when the inotify_simple package is installed, otherwise (and on network shares where inotify misses remote writes) by polling
+#when all workers are busy and the queue is full the watcher waits, so bags are never picked up faster than they can be processed
+def watch_bags(workers = 4, queue_size = 8, poll_interval = 5, settle_time = 30):
+    import queue
+    print('----WATCHING BAGS DIRECTORY----')
+    project_log_hand = storage.open(proj_log_file, 'r')
+    vars = project_log_hand.readlines()
+    project_log_hand.close()
+    container = vars[1].strip()
+    bags_dir = vars[2].strip()
+    path_container = os.path.join(proj_path, container)
+    path_bagsdir = os.path.join(proj_path, container, bags_dir)
+    bag_queue = queue.Queue(maxsize = queue_size)
+    bag_counts = {'ingested': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target = watch_bags_worker, args = (bag_queue, path_container, bag_counts, counts_lock), daemon = True)
+        thread.start()
+        threads.append(thread)
+    print('Watching {} with {} workers'.format(path_bagsdir, workers))
+    try:
+        for path_zip in watch_zipped_bags(path_bagsdir, poll_interval, settle_time):
+            print('queued bag: {}'.format(basename(path_zip)))
+            bag_queue.put(path_zip)
+    except KeyboardInterrupt:
+        print('stopping - waiting for {} queued bags to finish'.format(bag_queue.qsize()))
+    for thread in threads:
+        bag_queue.put(None)
+    for thread in threads:
+        thread.join()
+    print('Ingested {} bags | {} bags failed'.format(bag_counts['ingested'], bag_counts['failed']))
+    return bag_counts['failed'] == 0
+
+#yields the path of each zipped bag in the bags directory once it has been completely written
+#with inotify a bag is ready when the file copying it in is closed, when polling it is ready when its size and modification time have not changed for "settle_time" seconds
+#a bag is yielded again if it is copied in again under the same name (for example after a truncated copy failed), as its size and modification time change
+def watch_zipped_bags(path_bagsdir, poll_interval, settle_time):
+    try:
+        from inotify_simple import INotify, flags
+        inotify = INotify()
+        inotify.add_watch(path_bagsdir, flags.CLOSE_WRITE | flags.MOVED_TO)
+    except (ImportError, OSError):
+        inotify = None
+        print('inotify unavailable - polling for new bags every {} seconds'.format(poll_interval))
+    #path -> (size, modification time) of each bag when it was yielded
+    seen = dict()
+    pending = dict()
+    while True:
+        ready = []
+        if inotify is not None:
+            for event in inotify.read(timeout = int(poll_interval * 1000)):
+                if event.name.endswith('.zip'):
+                    ready.append(os.path.join(path_bagsdir, event.name))
+        else:
+            time.sleep(poll_interval)
+        now = time.time()
+        listed = set()
+        for file in storage.listdir(path_bagsdir):
+            path_bagsdirfile = os.path.join(path_bagsdir, file)
+            if not file.endswith('.zip'):
+                continue
+            listed.add(path_bagsdirfile)
+            try:
+                st = storage.stat(path_bagsdirfile)
+            except FileNotFoundError:
+                continue
+            signature = (st.st_size, st.st_mtime)
+            if seen.get(path_bagsdirfile) == signature:
+                continue
+            if path_bagsdirfile not in pending or pending[path_bagsdirfile][0] != signature:
+                pending[path_bagsdirfile] = (signature, now)
+            elif now - pending[path_bagsdirfile][1] >= settle_time:
+                ready.append(path_bagsdirfile)
+        #bags that have been ingested (and so removed) are forgotten
+        for path_bagsdirfile in [path for path in seen if path not in listed]:
+            del seen[path_bagsdirfile]
+        for path_bagsdirfile in ready:
+            try:
+                st = storage.stat(path_bagsdirfile)
+            except FileNotFoundError:
+                continue
+            signature = (st.st_size, st.st_mtime)
+            if seen.get(path_bagsdirfile) != signature:
+                seen[path_bagsdirfile] = signature
+                pending.pop(path_bagsdirfile, None)
+                yield path_bagsdirfile
+
+#takes zipped bags off the queue until it receives None, recording failures without stopping the service
+def watch_bags_worker(bag_queue, path_container, bag_counts, counts_lock):
+    while True:
+        path_zip = bag_queue.get()
+        if path_zip is None:
+            bag_queue.task_done()
+            break
+        try:
+            ingested = ingest_zipped_bag(path_zip, path_container)
+        except Exception as err:
+            print('ERROR: {} | {}'.format(basename(path_zip), err))
+            ingested = False
+        with counts_lock:
+            if ingested:
+                bag_counts['ingested'] += 1
+            else:
+                bag_counts['failed'] += 1
+        bag_queue.task_done()
+
+#runs a single zipped bag through the workflow, from extraction to the OPEX metadata for its PAX archive
+#returns False if the bag failed validation or has no matching asset directory in "container", leaving the extracted bag in the bags directory to be
+#rectified manually
+def ingest_zipped_bag(path_zip, path_container):
+    from bdbag import bdbag_api
+    path_bagsdir = os.path.dirname(path_zip)
+    print('extracting bag: {}'.format(basename(path_zip)))
+    path_bag = bdbag_api.extract_bag(path_zip, output_path = path_bagsdir, temp = False)
+    storage.remove(path_zip)
+    error_log_handle = storage.open(os.path.join(proj_path, 'validation_error_log.txt'), 'a')
+    try:
+        valid = validate_bag(path_bag, error_log_handle)
+    finally:
+        error_log_handle.close()
+    if not valid:
+        print('bag failed validation: {}'.format(basename(path_bag)))
+        return False
+    #the asset directory is looked up before process_bag() reverts the bag and removes its files
+    identifier = read_xml_fields(os.path.join(path_bag, 'data', 'MODS.xml'), first = [mods_identifier])[mods_identifier]
+    path_directory = os.path.join(path_container, identifier)
+    if not storage.isdir(path_directory):
+        print('no asset directory matches {} - bag left in {}'.format(identifier, path_bagsdir))
+        return False
+    process_bag(path_bag)
+    if not storage.isdir(os.path.join(path_directory, 'Representation_Preservation')):
+        representation_preservation_asset(path_directory)
+    storage.makedirs(os.path.join(path_directory, 'Representation_Access'), exist_ok = True)
+    merge_access_files(path_bag, path_directory)
+    storage.rmtree(path_bag)
+    stage_pax_asset(path_directory)
+    cleanup_metadata_asset(path_directory)
+    create_pax_asset(path_directory)
+    pax_metadata_asset(path_directory)
+    print('ingest ready: {}'.format(identifier + '.pax.zip'))
+    return True
+
+#watch_bags()
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# DISTRIBUTED MODE FOR SEVERAL WORKSTATIONS SHARING THE PROJECT FOLDER
+# queue_assets() is run once on any machine after validate_bags(), then distributed_worker() is run on every machine that mounts "proj_path"
+# Each worker claims an asset by creating a lease file in "proj_path/leases", and runs the steps from representation_preservation() through pax_metadata() on it
+# Leases are renewed while the worker is busy and expire after "lease_time" seconds if the worker dies, so another worker can claim the asset and carry on from the last completed step
+# Every step can be run again on an asset it was interrupted on, and retry_failed_assets() puts failed assets back in the queue
+# Bag paths in "asset_queue.txt" are relative to "proj_path", so workers can mount the project folder in different places (M:/ on Windows, /home/... on Linux)
+# NOTE the machines' clocks must be kept in sync (NTP), as lease expiry times are compared across hosts
+# Afterwards run cleanup_bags(), cleanup_directories(), ao_opex_metadata() and write_opex_container_md() as usual
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+
+#the steps run on each claimed asset, in order
+asset_steps = ['representation_preservation', 'process_bag', 'representation_access', 'merge_access', 'stage_pax', 'cleanup_metadata', 'create_pax', 'pax_metadata']
+
+#this function writes "asset_queue.txt" listing each asset directory in "container" with the path to its matching bag relative to "proj_path" (blank if there is no bag)
+#bags that failed validation are left out, the same as in process_bags()
+def queue_assets():
+    print('----QUEUEING ASSETS FOR DISTRIBUTED PROCESSING----')
+    project_log_hand = storage.open(proj_log_file, 'r')
+    vars = project_log_hand.readlines()
+    project_log_hand.close()
+    container = vars[1].strip()
+    bags_dir = vars[2].strip()
+    error_log_handle = storage.open(os.path.join(proj_path, 'validation_error_log.txt'), 'r')
+    error_log_str = error_log_handle.read()
+    error_log_handle.close()
+    path_container = os.path.join(proj_path, container)
+    path_bagsdir = os.path.join(proj_path, container, bags_dir)
+    bag_dict = dict()
+    for directory in storage.listdir(path_bagsdir):
+        if error_log_str.find(directory) != -1:
+            continue
+        path_bagsdirdirectory = os.path.join(path_bagsdir, directory)
+        path_bagmd = os.path.join(path_bagsdirdirectory, 'data', 'MODS.xml')
+        if not storage.exists(path_bagmd):
+            path_bagmd = os.path.join(path_bagsdirdirectory, 'MODS.xml')
+        identifier = read_xml_fields(path_bagmd, first = [mods_identifier])[mods_identifier]
+        bag_dict[identifier] = '/'.join([container, bags_dir, directory])
+    storage.makedirs(os.path.join(proj_path, 'leases'), exist_ok = True)
+    asset_count = 0
+    no_bag_count = 0
+    queue_hand = storage.open(os.path.join(proj_path, 'asset_queue.txt'), 'w')
+    for directory in storage.listdir(path_container):
+        if directory.startswith('bags_'):
+            continue
+        if directory not in bag_dict:
+            no_bag_count += 1
+        queue_hand.write(directory + '|' + bag_dict.get(directory, '') + '\n')
+        asset_count += 1
+    queue_hand.close()
+    print('Queued {} assets | {} assets have no matching bag'.format(asset_count, no_bag_count))
+
+#this function claims assets from "asset_queue.txt" one at a time and processes them until every asset is done or has failed
+#while other workers hold the remaining leases it waits "poll_interval" seconds and tries again, picking up any leases that have expired
+def distributed_worker(lease_time = 900, poll_interval = 60):
+    import socket
+    worker_id = socket.gethostname() + '-' + str(os.getpid())
+    print('----DISTRIBUTED WORKER {}----'.format(worker_id))
+    project_log_hand = storage.open(proj_log_file, 'r')
+    vars = project_log_hand.readlines()
+    project_log_hand.close()
+    container = vars[1].strip()
+    path_leases = os.path.join(proj_path, 'leases')
+    queue_hand = storage.open(os.path.join(proj_path, 'asset_queue.txt'), 'r')
+    asset_list = queue_hand.readlines()
+    queue_hand.close()
+    asset_count = 0
+    failed_count = 0
+    while True:
+        remaining = 0
+        for line in asset_list:
+            asset_info = line.split('|')
+            directory = asset_info[0].strip()
+            path_bag = ''
+            if asset_info[1].strip():
+                path_bag = os.path.join(proj_path, *asset_info[1].strip().split('/'))
+            path_lease = os.path.join(path_leases, directory + '.lease')
+            if storage.exists(os.path.join(path_leases, directory + '.done')) or storage.exists(os.path.join(path_leases, directory + '.failed')):
+                continue
+            remaining += 1
+            if not claim_lease(path_lease, worker_id, lease_time):
+                continue
+            #the queue may have been finished by another worker between the check above and the claim
+            if storage.exists(os.path.join(path_leases, directory + '.done')):
+                release_lease(path_lease, worker_id)
+                continue
+            print('claimed {}'.format(directory))
+            heartbeat_stop = threading.Event()
+            lease_lost = threading.Event()
+            heartbeat = threading.Thread(target = renew_lease, args = (path_lease, worker_id, lease_time, heartbeat_stop, lease_lost), daemon = True)
+            heartbeat.start()
+            marker = None
+            try:
+                process_asset(os.path.join(proj_path, container, directory), path_bag, path_leases, lease_lost)
+                marker = directory + '.done'
+                asset_count += 1
+            except LeaseLostError:
+                print('WARNING: stopped {} because the lease was lost, another worker will carry on'.format(directory))
+            except Exception as err:
+                print('ERROR: {} | {}'.format(directory, err))
+                marker = directory + '.failed'
+                failed_count += 1
+                failed_hand = storage.open(os.path.join(path_leases, marker), 'w')
+                failed_hand.write(worker_id + '|' + repr(err) + '\n')
+                failed_hand.close()
+            heartbeat_stop.set()
+            heartbeat.join()
+            if marker is None:
+                continue
+            if marker.endswith('.done'):
+                storage.open(os.path.join(path_leases, marker), 'w').close()
+            release_lease(path_lease, worker_id)
+            remaining -= 1
+        if remaining == 0:
+            break
+        print('{} assets are leased by other workers - checking again in {} seconds'.format(remaining, poll_interval))
+        time.sleep(poll_interval)
+    print('Worker {} processed {} assets | {} failed'.format(worker_id, asset_count, failed_count))
+    return failed_count == 0
+
+#raised in process_asset() when the worker's lease on the asset has expired or been taken over
+class LeaseLostError(Exception):
+    pass
+
+#runs the per-asset steps on a single asset directory, skipping any steps recorded as complete in "<directory>.progress" by a previous worker
+#a step a previous worker was part way through when it died is run again, so every step has to cope with finding its own output half done
+#"lease_lost" is checked before each step and before it is recorded, a step that is already running is not interrupted
+def process_asset(path_directory, path_bag, path_leases, lease_lost = None):
+    directory = basename(path_directory)
+    path_progress = os.path.join(path_leases, directory + '.progress')
+    completed = []
+    if storage.exists(path_progress):
+        progress_hand = storage.open(path_progress, 'r')
+        completed = [line.strip() for line in progress_hand.readlines()]
+        progress_hand.close()
+        print('resuming {} after {}'.format(directory, completed[-1] if completed else 'no completed steps'))
+    for step in asset_steps:
+        if step in completed:
+            continue
+        if lease_lost is not None and lease_lost.is_set():
+            raise LeaseLostError(directory)
+        if step == 'representation_preservation':
+            representation_preservation_asset(path_directory)
+        elif step == 'process_bag' and path_bag:
+            process_bag(path_bag)
+        elif step == 'representation_access':
+            storage.makedirs(os.path.join(path_directory, 'Representation_Access'), exist_ok = True)
+        elif step == 'merge_access' and path_bag:
+            merge_access_files(path_bag, path_directory)
+        elif step == 'stage_pax':
+            stage_pax_asset(path_directory)
+        elif step == 'cleanup_metadata':
+            cleanup_metadata_asset(path_directory)
+        elif step == 'create_pax':
+            create_pax_asset(path_directory)
+        elif step == 'pax_metadata':
+            pax_metadata_asset(path_directory)
+        if lease_lost is not None and lease_lost.is_set():
+            raise LeaseLostError(directory)
+        progress_hand = storage.open(path_progress, 'a')
+        progress_hand.write(step + '\n')
+        progress_hand.close()
+
+#reads a lease file, returning (worker_id, expiry time) or None if it is missing or still being written
+def read_lease(path_lease):
+    try:
+        lease_hand = storage.open(path_lease, 'r')
+        lease = lease_hand.read().split('|')
+        lease_hand.close()
+        return (lease[0], float(lease[1]))
+    except (OSError, IndexError, ValueError):
+        return None
+
+#claims an asset by creating its lease file exclusively, which only one worker can do even on a network share
+#an expired lease is first renamed out of the way (again only one worker's rename can succeed) and then removed
+#returns True if this worker now holds the lease
+def claim_lease(path_lease, worker_id, lease_time):
+    try:
+        lease_hand = storage.open(path_lease, 'x')
+    except FileExistsError:
+        lease = read_lease(path_lease)
+        if lease is None or lease[1] > time.time():
+            return False
+        path_expired = path_lease + '.' + worker_id + '.expired'
+        try:
+            storage.rename(path_lease, path_expired)
+        except OSError:
+            return False
+        #another worker may have replaced the expired lease between reading and renaming it, in which case it is put back
+        if read_lease(path_expired) != lease:
+            storage.rename(path_expired, path_lease)
+            return False
+        storage.remove(path_expired)
+        print('reclaimed expired lease held by {}'.format(lease[0]))
+        return claim_lease(path_lease, worker_id, lease_time)
+    lease_hand.write(worker_id + '|' + str(time.time() + lease_time))
+    lease_hand.close()
+    return True
+
+#extends this worker's lease every third of "lease_time" until "heartbeat_stop" is set
+#the new lease is written beside the old one and swapped in with storage.replace, so other workers never read a partly written lease
+#a lease that cannot be read (for example while another worker has it renamed aside in claim_lease()) is tried again every few seconds until the lease
+#would expire, and "lease_lost" is set once it has been taken over by another worker or has expired
+def renew_lease(path_lease, worker_id, lease_time, heartbeat_stop, lease_lost):
+    expires = time.time() + lease_time
+    wait = lease_time / 3
+    while not heartbeat_stop.wait(wait):
+        lease = read_lease(path_lease)
+        if lease is not None and lease[0] != worker_id:
+            print('WARNING: lease {} was taken over by {}'.format(basename(path_lease), lease[0]))
+            lease_lost.set()
+            return
+        if lease is not None:
+            try:
+                path_renew = path_lease + '.' + worker_id + '.renew'
+                renew_hand = storage.open(path_renew, 'w')
+                renew_hand.write(worker_id + '|' + str(time.time() + lease_time))
+                renew_hand.close()
+                storage.replace(path_renew, path_lease)
+                expires = time.time() + lease_time
+                wait = lease_time / 3
+                continue
+            except OSError as err:
+                print('WARNING: could not renew lease {} | {}'.format(basename(path_lease), err))
+        if time.time() >= expires:
+            print('WARNING: lease {} expired before it could be renewed by {}'.format(basename(path_lease), worker_id))
+            lease_lost.set()
+            return
+        wait = min(5, max(expires - time.time(), 0.1), lease_time / 3)
+
+#removes this worker's lease file, unless another worker has since taken it over
+def release_lease(path_lease, worker_id):
+    lease = read_lease(path_lease)
+    if lease is not None and lease[0] == worker_id:
+        storage.remove(path_lease)
+
+#this function removes the ".failed" markers of every queued asset, so that the next distributed_worker() tries them again from their last completed step
+def retry_failed_assets():
+    print('----RETRYING FAILED ASSETS----')
+    path_leases = os.path.join(proj_path, 'leases')
+    queue_hand = storage.open(os.path.join(proj_path, 'asset_queue.txt'), 'r')
+    asset_list = queue_hand.readlines()
+    queue_hand.close()
+    retry_count = 0
+    for line in asset_list:
+        path_failed = os.path.join(path_leases, line.split('|')[0].strip() + '.failed')
+        if storage.exists(path_failed):
+            storage.remove(path_failed)
+            retry_count += 1
+    print('Queued {} failed assets to be tried again'.format(retry_count))
+
+#this function prints how many queued assets are done, failed, leased and waiting
+def queue_status():
+    print('----DISTRIBUTED QUEUE STATUS----')
+    path_leases = os.path.join(proj_path, 'leases')
+    queue_hand = storage.open(os.path.join(proj_path, 'asset_queue.txt'), 'r')
+    asset_list = queue_hand.readlines()
+    queue_hand.close()
+    status = {'done': 0, 'failed': 0, 'leased': 0, 'waiting': 0}
+    for line in asset_list:
+        directory = line.split('|')[0].strip()
+        if storage.exists(os.path.join(path_leases, directory + '.done')):
+            status['done'] += 1
+        elif storage.exists(os.path.join(path_leases, directory + '.failed')):
+            status['failed'] += 1
+            print('failed: {}'.format(directory))
+        elif storage.exists(os.path.join(path_leases, directory + '.lease')):
+            status['leased'] += 1
+            lease = read_lease(os.path.join(path_leases, directory + '.lease'))
+            if lease is not None:
+                print('leased: {} by {}{}'.format(directory, lease[0], ' (expired)' if lease[1] < time.time() else ''))
+        else:
+            status['waiting'] += 1
+    print('{} done | {} failed | {} leased | {} waiting'.format(status['done'], status['failed'], status['leased'], status['waiting']))
+
+#queue_assets()
+#distributed_worker()
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# COMMAND LINE
+# python -m islandora_preservica --project-path "M:/IDT/DAM/My Project" create-container
+# Run with -m from the folder containing the script, so Python uses its cached bytecode instead of compiling the whole file on every call
+# Every stage above is a subcommand (run with --help for the list), in the same order as the workflow
+# The exit code is 1 when the stage reports failures (invalid bags, failed assets or archives, or failed batched operations), 0 otherwise
+# The project folder comes from --project-path, then the ISLANDORA_PRESERVICA_PROJECT environment variable, then the "path" option in the [project] section of
+# the config file (--config, or islandora_preservica.ini in the current directory), then proj_path above
+# bdbag, bagit, openpyxl, zipfile, json, mmap, queue, socket and tracemalloc are imported inside the stages that use them, so quick stages such as status or
+# write-opex-container-md start straight away
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+
+#stages that take no options, in workflow order, with the help shown by --help
+cli_stages = [
+    (create_container, 'rename the preservation masters directory into the container and start the project log'),
+    (folder_ds_files, 'split the preservation masters into a directory per asset'),
+    (create_bags_dir, 'create the directory the zipped bags are copied into'),
+    (extract_bags, 'unzip the bags in the bags directory'),
+    (validate_bags, 'validate the unzipped bags'),
+    (create_id_ss, 'write the spreadsheet mapping preservation files, access files and bag ids'),
+    (representation_preservation, 'move the preservation masters into Representation_Preservation folders'),
+    (process_bags, 'revert the bags into plain directories and remove unneeded files'),
+    (representation_access, 'create the Representation_Access folders'),
+    (access_id_path, 'write the MODS identifier and path of every access copy'),
+    (merge_access_preservation, 'move the access copies and metadata into the asset directories'),
+    (cleanup_bags, 'delete the bags directory and access_ids.txt'),
+    (stage_pax_content, 'move the representation folders into the PAX staging directories'),
+    (cleanup_metadata, 'remove the excess XML headers from the metadata files'),
+    (create_pax, 'zip each asset into a PAX archive'),
+    (pax_metadata, 'write the OPEX metadata for each PAX archive'),
+    (cleanup_directories, 'delete the files and directories used to build the PAX archives'),
+    (ao_opex_metadata, 'write the OPEX metadata for the archival object folders'),
+    (write_opex_container_md, 'write the OPEX metadata for the container'),
+    (folder_ds_files_alt1, 'split the preservation masters by identifier ranges (alternative to folder-ds-files)'),
+    (rename_bags, 'rename the bags if the project needs it'),
+    (revert_bags, 'revert the bags into plain directories (alternative to process-bags)'),
+    (process_bags_islandora, 'process the bags when preservation and access copies both come from Islandora'),
+    (representation_preservation_access, 'build the representation folders when the bags hold both preservation and access copies'),
+    (queue_assets, 'queue the assets in the container for distributed-worker'),
+    (queue_status, 'show how many queued assets are done, failed, leased and waiting'),
+    (retry_failed_assets, 'put the failed queued assets back in the queue for distributed-worker')]
+
+#points the stages at a different project folder
+def set_project(path):
+    global proj_path, proj_log_file
+    proj_path = path
+    proj_log_file = os.path.join(proj_path, 'project_log.txt')
+
+#reads the [project] section of the config file, returning an empty dict if there is no config file
+def read_config(path_config):
+    import configparser
+    config = configparser.ConfigParser()
+    if not config.read(path_config) or not config.has_section('project'):
+        return dict()
+    return dict(config.items('project'))
+
+#this function prints the project folder, the variables in the project log and the number of asset directories in the container
+def project_status():
+    print('----PROJECT STATUS----')
+    print('Project folder: {}'.format(proj_path))
+    if not storage.exists(proj_log_file):
+        print('No project log, run create-container to start the project')
+        return
+    project_log_hand = storage.open(proj_log_file, 'r')
+    vars = [line.strip() for line in project_log_hand.readlines()]
+    project_log_hand.close()
+    for label, value in zip(['Started', 'Container', 'Bags directory'], vars):
+        print('{}: {}'.format(label, value))
+    path_container = os.path.join(proj_path, vars[1])
+    if storage.isdir(path_container):
+        directories = [directory for directory in storage.listdir(path_container) if storage.isdir(os.path.join(path_container, directory))]
+        print('{} directories in the container'.format(len(directories)))
+    if storage.exists(os.path.join(proj_path, 'asset_queue.txt')):
+        queue_status()
+
+def main(argv = None):
+    global orig_dir, metadata_workers, pax_hash_while_writing, xml_use_lxml
+    import argparse
+    parser = argparse.ArgumentParser(prog = 'islandora_preservica', description = 'Turn Islandora bags and preservation masters into PAX/OPEX containers for Preservica incremental ingest')
+    parser.add_argument('--project-path', help = 'project folder containing the preservation masters and bags')
+    parser.add_argument('--config', default = 'islandora_preservica.ini', help = 'config file with a [project] section (default: %(default)s)')
+    parser.add_argument('--orig-dir', help = 'directory of preservation masters in the project folder (default: {})'.format(orig_dir))
+    parser.add_argument('--metadata-workers', type = int, help = 'threads used for batched mkdir/move/rename operations (default: {})'.format(metadata_workers))
+    parser.add_argument('--mb-per-sec', type = float, help = 'limit reads and writes to the project folder to this many MB per second')
+    parser.add_argument('--ops-per-sec', type = float, help = 'limit metadata operations on the project folder to this many per second')
+    parser.add_argument('--io-report-interval', type = float, help = 'with --mb-per-sec or --ops-per-sec, print the I/O rates every this many seconds (they are always printed when the stage finishes)')
+    parser.add_argument('--no-lxml', action = 'store_true', help = 'parse MODS.xml and DC.xml with xml.etree even if lxml is installed')
+    parser.add_argument('--xml-stats', action = 'store_true', help = 'print the time, bytes read and peak memory of the MODS.xml and DC.xml parsing when the stage finishes')
+    parser.add_argument('--xml-stats-csv', metavar = 'CSV', help = 'also write the time, bytes read and peak memory of every record parsed to this CSV file (implies --xml-stats)')
+    subparsers = parser.add_subparsers(dest = 'stage', metavar = 'stage')
+    subparsers.required = True
+    subparsers.add_parser('status', help = 'show the project log and progress').set_defaults(function = lambda args: project_status())
+    for function, stage_help in cli_stages:
+        stage_parser = subparsers.add_parser(function.__name__.replace('_', '-'), aliases = [function.__name__], help = stage_help)
+        stage_parser.set_defaults(function = lambda args, function = function: function())
+        if function is create_pax:
+            stage_parser.add_argument('--hash-while-writing', action = 'store_true', help = 'calculate the SHA-1 of each PAX archive while writing it instead of reading it back (files over {} MB are read twice)'.format(pax_chunk_size // (1024 * 1024)))
+    stage_parser = subparsers.add_parser('find-duplicates', aliases = ['find_duplicates'], help = 'report files with identical content in the container')
+    stage_parser.add_argument('--min-size', type = int, default = 1024 * 1024, help = 'ignore files smaller than this many bytes (default: %(default)s)')
+    stage_parser.add_argument('--workers', type = int, default = 4)
+    stage_parser.add_argument('--link', action = 'store_true', help = 'replace each duplicate with a hard link to the first copy')
+    stage_parser.set_defaults(function = lambda args: find_duplicates(min_size = args.min_size, workers = args.workers, link = args.link))
+    stage_parser = subparsers.add_parser('audit-container', aliases = ['audit_container'], help = 'check every PAX archive against its OPEX checksum')
+    stage_parser.add_argument('--workers', type = int, default = 4)
+    stage_parser.add_argument('--full', action = 'store_true', help = 'check every archive again, not only the ones that changed since the last audit')
+    stage_parser.set_defaults(function = lambda args: audit_container(workers = args.workers, incremental = not args.full))
+    stage_parser = subparsers.add_parser('watch-bags', aliases = ['watch_bags'], help = 'process zipped bags as they are copied into the bags directory')
+    stage_parser.add_argument('--workers', type = int, default = 4)
+    stage_parser.add_argument('--queue-size', type = int, default = 8)
+    stage_parser.add_argument('--poll-interval', type = float, default = 5)
+    stage_parser.add_argument('--settle-time', type = float, default = 30)
+    stage_parser.set_defaults(function = lambda args: watch_bags(workers = args.workers, queue_size = args.queue_size, poll_interval = args.poll_interval, settle_time = args.settle_time))
+    stage_parser = subparsers.add_parser('distributed-worker', aliases = ['distributed_worker'], help = 'claim and process queued assets until the queue is empty')
+    stage_parser.add_argument('--lease-time', type = float, default = 900)
+    stage_parser.add_argument('--poll-interval', type = float, default = 60)
+    stage_parser.set_defaults(function = lambda args: distributed_worker(lease_time = args.lease_time, poll_interval = args.poll_interval))
+    args = parser.parse_args(argv)
+    config = read_config(args.config)
+    project_path = args.project_path or os.environ.get('ISLANDORA_PRESERVICA_PROJECT') or config.get('path')
+    if project_path:
+        set_project(project_path)
+    if not storage.isdir(proj_path):
+        parser.error('project folder {} does not exist, set it with --project-path'.format(proj_path))
+    orig_dir = args.orig_dir or config.get('orig_dir', orig_dir)
+    metadata_workers = args.metadata_workers or int(config.get('metadata_workers', metadata_workers))
+    pax_hash_while_writing = getattr(args, 'hash_while_writing', False) or config.get('pax_hash_while_writing', str(pax_hash_while_writing)).lower() in ('1', 'true', 'yes')
+    mb_per_sec = args.mb_per_sec or config.get('mb_per_sec')
+    ops_per_sec = args.ops_per_sec or config.get('ops_per_sec')
+    io_report_interval = args.io_report_interval or config.get('io_report_interval')
+    scheduler = None
+    if mb_per_sec or ops_per_sec:
+        scheduler = enable_io_limits(float(mb_per_sec) if mb_per_sec else None, float(ops_per_sec) if ops_per_sec else None, float(io_report_interval) if io_report_interval else None)
+    xml_use_lxml = not args.no_lxml and config.get('xml_use_lxml', str(xml_use_lxml)).lower() in ('1', 'true', 'yes')
+    args.xml_stats = args.xml_stats or bool(args.xml_stats_csv)
+    if args.xml_stats:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        result = args.function(args)
+    finally:
+        if scheduler is not None:
+            scheduler.close()
+            scheduler.report()
+    if args.xml_stats:
+        xml_stats.report()
+        if args.xml_stats_csv:
+            xml_stats.write_csv(args.xml_stats_csv)
+    #stages return False when any asset, bag or operation failed, so a script can stop before uploading the container
+    return 1 if result is False else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
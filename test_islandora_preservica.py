@@ -0,0 +1,246 @@
+import io
+import os
+import time
+import hashlib
+import zipfile
+import threading
+import unittest
+import xml.etree.ElementTree as ET
+from unittest import mock
+
+import islandora_preservica as ip
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+# TESTS
+# Every test runs against a fresh MemoryStorage, so nothing touches the disk and bdbag, bagit and openpyxl are not needed
+# python -m pytest test_islandora_preservica.py (or python -m unittest test_islandora_preservica) from the folder containing the script
+#------------------------------------------------------------------------------------------------------------------------------------------------------
+
+class MemoryStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_storage = ip.storage
+        self.storage = ip.MemoryStorage()
+        ip.storage = self.storage
+
+    def tearDown(self):
+        ip.storage = self.saved_storage
+
+    def write_file(self, path, data):
+        self.storage.makedirs(os.path.dirname(path), exist_ok = True)
+        file_hand = self.storage.open(path, 'wb')
+        file_hand.write(data)
+        file_hand.close()
+
+    def read_file(self, path):
+        file_hand = self.storage.open(path, 'rb')
+        data = file_hand.read()
+        file_hand.close()
+        return data
+
+class PaxWriterTest(MemoryStorageTestCase):
+
+    def setUp(self):
+        MemoryStorageTestCase.setUp(self)
+        self.zip_dir = '/asset/pax_stage'
+        self.contents = {
+            'Representation_Preservation/a/a.tif': os.urandom(50000),
+            'Representation_Preservation/a/small.txt': b'small file',
+            'Representation_Access/a/empty.jpg': b'',
+            'Representation_Access/a/café.jpg': os.urandom(3000)}
+        for arcname, data in self.contents.items():
+            self.write_file(os.path.join(self.zip_dir, arcname), data)
+
+    #writes the archive with small chunks, so large members go through the chunked CRC-32 and copy passes
+    def write_pax(self):
+        with mock.patch.object(ip, 'pax_chunk_size', 4096):
+            sha1_checksum = ip.write_pax_stored('/asset/asset.zip', self.zip_dir)
+        return sha1_checksum, self.read_file('/asset/asset.zip')
+
+    def check_archive(self, sha1_checksum, data):
+        self.assertEqual(sha1_checksum, hashlib.sha1(data).hexdigest())
+        pax_obj = zipfile.ZipFile(io.BytesIO(data))
+        self.assertIsNone(pax_obj.testzip())
+        self.assertEqual(set(pax_obj.namelist()), set(self.contents) | set(['Representation_Access/', 'Representation_Access/a/', 'Representation_Preservation/', 'Representation_Preservation/a/']))
+        for zinfo in pax_obj.infolist():
+            self.assertEqual(zinfo.compress_type, zipfile.ZIP_STORED)
+        for arcname, member_data in self.contents.items():
+            self.assertEqual(pax_obj.read(arcname), member_data)
+        pax_obj.close()
+
+    def test_write_pax_stored_reads_back_with_zipfile(self):
+        sha1_checksum, data = self.write_pax()
+        self.check_archive(sha1_checksum, data)
+        self.assertNotIn(zipfile.stringEndArchive64, data)
+
+    #with the Zip64 limit lowered, the large member gets Zip64 extra fields and the archive the Zip64 end records, without writing GBs of data
+    def test_write_pax_stored_zip64(self):
+        with mock.patch.object(zipfile, 'ZIP64_LIMIT', 20000):
+            sha1_checksum, data = self.write_pax()
+        self.assertIn(zipfile.stringEndArchive64, data)
+        self.check_archive(sha1_checksum, data)
+        pax_obj = zipfile.ZipFile(io.BytesIO(data))
+        zinfo = pax_obj.getinfo('Representation_Preservation/a/a.tif')
+        self.assertEqual(zinfo.file_size, 50000)
+        self.assertTrue(zinfo.extra)
+        pax_obj.close()
+
+    def test_check_pax_passes_intact_archive(self):
+        sha1_checksum, data = self.write_pax()
+        with mock.patch.object(ip, 'pax_chunk_size', 4096):
+            self.assertEqual(ip.check_pax('/asset/asset.zip'), (sha1_checksum, []))
+
+    def test_check_pax_flags_corrupted_member(self):
+        sha1_checksum, data = self.write_pax()
+        pax_obj = zipfile.ZipFile(io.BytesIO(data))
+        zinfo = pax_obj.getinfo('Representation_Preservation/a/a.tif')
+        pax_obj.close()
+        #flips a byte in the middle of the member's data, after its local header
+        position = zinfo.header_offset + zipfile.sizeFileHeader + len(zinfo.filename.encode('utf-8')) + len(zinfo.extra) + 25000
+        corrupted = bytearray(data)
+        corrupted[position] ^= 0xFF
+        self.write_file('/asset/asset.zip', bytes(corrupted))
+        with mock.patch.object(ip, 'pax_chunk_size', 4096):
+            pax_sha1, bad_members = ip.check_pax('/asset/asset.zip')
+        self.assertEqual(bad_members, ['Representation_Preservation/a/a.tif'])
+        self.assertEqual(pax_sha1, hashlib.sha1(bytes(corrupted)).hexdigest())
+        self.assertNotEqual(pax_sha1, sha1_checksum)
+
+class MetadataBatchTest(MemoryStorageTestCase):
+
+    #the parent mkdir is slowed down, so without the dependencies the operations below it would run first and fail
+    def test_operations_wait_for_earlier_operations_on_parents_and_contents(self):
+        order = []
+        def slow_mkdir(path):
+            time.sleep(0.05)
+            self.storage.mkdir(path)
+            order.append(path)
+        def write(path):
+            self.write_file(path, b'data')
+            order.append(path)
+        batch = ip.MetadataBatch()
+        batch.call(slow_mkdir, ('/t',), ['/t'])
+        batch.call(slow_mkdir, ('/t/a',), ['/t/a'])
+        batch.call(write, ('/t/a/f1',), ['/t/a/f1'])
+        batch.call(write, ('/t/a/f2',), ['/t/a/f2'])
+        batch.rename('/t/a', '/t/b')
+        self.assertEqual(batch.run(workers = 8), [])
+        self.assertEqual(order[:2], ['/t', '/t/a'])
+        self.assertEqual(set(order[2:]), set(['/t/a/f1', '/t/a/f2']))
+        self.assertEqual(sorted(self.storage.listdir('/t/b')), ['f1', 'f2'])
+        self.assertFalse(self.storage.exists('/t/a'))
+
+    def test_operations_depending_on_a_failed_operation_are_skipped(self):
+        self.storage.mkdir('/t')
+        batch = ip.MetadataBatch()
+        batch.mkdir('/missing/a', 'created /missing/a')
+        batch.mkdir('/missing/a/b', 'created /missing/a/b')
+        batch.mkdir('/t/other', 'created /t/other')
+        errors = batch.run(workers = 4)
+        self.assertEqual([description for description, err in errors], ['created /missing/a', 'created /missing/a/b'])
+        self.assertIsInstance(errors[0][1], FileNotFoundError)
+        self.assertIsInstance(errors[1][1], RuntimeError)
+        self.assertTrue(self.storage.isdir('/t/other'))
+
+    def test_raise_errors(self):
+        batch = ip.MetadataBatch()
+        batch.mkdir('/missing/a')
+        with self.assertRaises(FileNotFoundError):
+            batch.run(raise_errors = True)
+
+class ReadXMLFieldsTest(MemoryStorageTestCase):
+
+    mods = b'''<?xml version="1.0" encoding="UTF-8"?>
+<mods xmlns="http://www.loc.gov/mods/v3">
+  <relatedItem><identifier>nested-before</identifier></relatedItem>
+  <titleInfo><title>Title</title></titleInfo>
+  <identifier type="local">first</identifier>
+  <relatedItem><identifier>nested-between</identifier><relatedItem><identifier>nested-deeper</identifier></relatedItem></relatedItem>
+  <identifier>second</identifier>
+</mods>
+'''
+    dc = b'''<?xml version="1.0" encoding="UTF-8"?>
+<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <dc:title>Title</dc:title>
+  <dc:identifier>id-1</dc:identifier>
+  <dc:identifier>id-2</dc:identifier>
+</oai_dc:dc>
+'''
+
+    def setUp(self):
+        MemoryStorageTestCase.setUp(self)
+        self.saved_stats = ip.xml_stats
+        ip.xml_stats = ip.XMLStats()
+
+    def tearDown(self):
+        ip.xml_stats = self.saved_stats
+        MemoryStorageTestCase.tearDown(self)
+
+    def test_matches_find_and_findall_with_nested_identifiers(self):
+        self.write_file('/r/MODS.xml', self.mods)
+        root = ET.fromstring(self.mods)
+        fields = ip.read_xml_fields('/r/MODS.xml', first = [ip.mods_identifier])
+        self.assertEqual(fields[ip.mods_identifier], root.find(ip.mods_identifier).text)
+        fields = ip.read_xml_fields('/r/MODS.xml', every = [ip.mods_identifier])
+        self.assertEqual(fields[ip.mods_identifier], [elem.text for elem in root.findall(ip.mods_identifier)])
+
+    def test_first_and_every_together(self):
+        self.write_file('/r/DC.xml', self.dc)
+        root = ET.fromstring(self.dc)
+        fields = ip.read_xml_fields('/r/DC.xml', first = [ip.dc_title], every = [ip.dc_identifier])
+        self.assertEqual(fields[ip.dc_title], root.find(ip.dc_title).text)
+        self.assertEqual(fields[ip.dc_identifier], [elem.text for elem in root.findall(ip.dc_identifier)])
+        self.assertEqual(ip.xml_stats.records, 1)
+        self.assertEqual(ip.xml_stats.rows[0][0], '/r/DC.xml')
+
+    def test_missing_tag_is_none(self):
+        self.write_file('/r/DC.xml', self.dc)
+        fields = ip.read_xml_fields('/r/DC.xml', first = [ip.mods_identifier])
+        self.assertIsNone(fields[ip.mods_identifier])
+
+class LeaseTest(MemoryStorageTestCase):
+
+    def setUp(self):
+        MemoryStorageTestCase.setUp(self)
+        self.storage.makedirs('/p/leases')
+        self.path_lease = '/p/leases/asset.lease'
+
+    def write_lease(self, worker_id, expires):
+        self.write_file(self.path_lease, '{}|{}'.format(worker_id, expires).encode('ascii'))
+
+    def test_claim_creates_lease(self):
+        self.assertTrue(ip.claim_lease(self.path_lease, 'worker-1', 60))
+        self.assertEqual(ip.read_lease(self.path_lease)[0], 'worker-1')
+        self.assertFalse(ip.claim_lease(self.path_lease, 'worker-2', 60))
+
+    def test_claim_reclaims_expired_lease(self):
+        self.write_lease('worker-1', time.time() - 10)
+        self.assertTrue(ip.claim_lease(self.path_lease, 'worker-2', 60))
+        worker_id, expires = ip.read_lease(self.path_lease)
+        self.assertEqual(worker_id, 'worker-2')
+        self.assertGreater(expires, time.time())
+        self.assertEqual(self.storage.listdir('/p/leases'), ['asset.lease'])
+
+    def test_claim_leaves_live_lease(self):
+        expires = time.time() + 60
+        self.write_lease('worker-1', expires)
+        self.assertFalse(ip.claim_lease(self.path_lease, 'worker-2', 60))
+        self.assertEqual(ip.read_lease(self.path_lease), ('worker-1', expires))
+
+    #only one of several workers racing for the same expired lease gets it
+    def test_one_worker_reclaims_expired_lease(self):
+        self.write_lease('worker-0', time.time() - 10)
+        results = dict()
+        def claim(worker_id):
+            results[worker_id] = ip.claim_lease(self.path_lease, worker_id, 60)
+        threads = [threading.Thread(target = claim, args = ('worker-{}'.format(i),)) for i in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        winners = [worker_id for worker_id, claimed in results.items() if claimed]
+        self.assertEqual(len(winners), 1)
+        self.assertEqual(ip.read_lease(self.path_lease)[0], winners[0])
+
+if __name__ == '__main__':
+    unittest.main()